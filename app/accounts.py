@@ -0,0 +1,144 @@
+import math
+import smtplib
+import time
+from app.rate_limiter import AdaptiveRateLimiter
+
+# Réponses 5xx indiquant que le compte lui-même a atteint sa limite d'envoi (Gmail : 5.4.5).
+# Une limite temporaire (4.7.28) passe par le limiteur de débit et les relances
+ACCOUNT_LIMIT_MARKERS = ("5.4.5", "sending limit", "sending quota")
+# Échecs temporaires consécutifs avant de suspendre un compte
+SUSPEND_AFTER_FAILURES = 3
+# Durée de la première suspension, doublée à chaque nouvelle suspension
+SUSPEND_SECONDS = 60.0
+# Fenêtre glissante du quota journalier
+QUOTA_WINDOW_SECONDS = 24 * 3600
+
+def is_account_error(error):
+    """
+    Indique si l'erreur concerne le compte d'envoi plutôt que le destinataire :
+    identifiants refusés, expéditeur refusé (5xx) ou limite d'envoi du compte
+    atteinte (5xx). L'envoi peut alors être repris par un autre compte.
+    Une réponse 4xx n'est jamais une erreur de compte : elle est temporaire.
+    """
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500:
+        if isinstance(error, smtplib.SMTPSenderRefused):
+            return True
+        text = error.smtp_error.decode("utf-8", "replace") if isinstance(error.smtp_error, bytes) else str(error.smtp_error)
+        return any(marker in text.lower() for marker in ACCOUNT_LIMIT_MARKERS)
+    return False
+
+class SenderAccount:
+    """
+    Compte d'envoi : identifiants SMTP, quota journalier, débit et nombre de
+    connexions propres. Garde aussi son état pendant la campagne (envois en
+    cours, échecs consécutifs, suspension, désactivation). Cet état n'est
+    modifié que par la boucle du dispatcher.
+    `already_sent` est le nombre d'envois déjà faits dans la fenêtre du quota
+    (voir SendJournal.sent_since).
+    """
+
+    def __init__(self, username, password, smtp_server="smtp.gmail.com", smtp_port=587,
+                 daily_quota=None, rate_per_minute=None, max_workers=4, already_sent=0):
+        self.username = username
+        self.password = password
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.daily_quota = daily_quota
+        self.max_workers = max_workers
+        self.limiter = AdaptiveRateLimiter(rate_per_minute) if rate_per_minute else None
+        self.sent = already_sent
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.suspensions = 0
+        self.suspended_until = 0.0
+        self.disabled_reason = None
+
+    @property
+    def capacity(self):
+        """Envois soumis au maximum en même temps pour ce compte."""
+        return self.max_workers * 4
+
+    @property
+    def quota_left(self):
+        return math.inf if self.daily_quota is None else max(0, self.daily_quota - self.sent)
+
+    @property
+    def remaining(self):
+        """Quota restant, envois en cours déduits."""
+        return self.quota_left - self.in_flight
+
+    @property
+    def exhausted(self):
+        """Le compte ne pourra plus rien envoyer pendant cette campagne."""
+        return self.disabled_reason is not None or self.quota_left <= 0
+
+    def available(self, now):
+        return not self.exhausted and self.remaining > 0 and now >= self.suspended_until and self.in_flight < self.capacity
+
+    def status(self):
+        if self.disabled_reason is not None:
+            return f"désactivé ({self.disabled_reason})"
+        if self.quota_left <= 0:
+            return "quota atteint"
+        return "actif"
+
+    def on_success(self):
+        self.in_flight -= 1
+        self.sent += 1
+        self.consecutive_failures = 0
+
+    def on_failure(self, error, transient, suspend=True):
+        """
+        Met à jour l'état du compte après un échec. Retourne True si le compte
+        vient d'être désactivé : l'envoi doit alors être confié à un autre compte.
+        Si `suspend`, des échecs temporaires répétés suspendent le compte.
+        """
+        self.in_flight -= 1
+        if is_account_error(error):
+            if self.disabled_reason is None:
+                self.disabled_reason = str(error)
+                print(f"Log (accounts): Compte {self.username} désactivé : {error}")
+            return True
+        if transient and suspend:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= SUSPEND_AFTER_FAILURES:
+                delay = SUSPEND_SECONDS * 2 ** self.suspensions
+                self.suspensions += 1
+                self.consecutive_failures = 0
+                self.suspended_until = time.monotonic() + delay
+                print(f"Log (accounts): Compte {self.username} suspendu {delay:.0f} s après des échecs temporaires répétés")
+        return False
+
+class AccountPool:
+    """
+    Ensemble des comptes d'une campagne. Chaque envoi est confié au compte
+    disponible ayant le plus de quota restant (à égalité, le moins chargé),
+    ce qui équilibre le quota restant entre les comptes.
+    """
+
+    def __init__(self, accounts):
+        if not accounts:
+            raise ValueError("Au moins un compte d'envoi est nécessaire.")
+        self.accounts = list(accounts)
+
+    def pick(self, now=None):
+        """Compte à utiliser pour le prochain envoi, ou None si aucun n'est disponible."""
+        now = time.monotonic() if now is None else now
+        candidates = [account for account in self.accounts if account.available(now)]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda account: (account.remaining, -account.in_flight / account.max_workers))
+
+    @property
+    def exhausted(self):
+        return all(account.exhausted for account in self.accounts)
+
+    def next_wakeup(self, now):
+        """Fin de la prochaine suspension, si un compte encore utilisable est suspendu."""
+        wakeups = [a.suspended_until for a in self.accounts if not a.exhausted and a.suspended_until > now]
+        return min(wakeups) if wakeups else None
+
+    def describe(self):
+        return "; ".join(f"{account.username} : {account.status()}" for account in self.accounts)
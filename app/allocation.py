@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+class AllocationStrategy:
+    """
+    Règle d'attribution des places : réordonne les contacts avant leur
+    alignement avec les fichiers de places triés. L'implémentation par défaut
+    conserve l'ordre du fichier contacts.
+    """
+
+    def order_contacts(self, contacts_df):
+        return contacts_df
+
+class PriorityTierStrategy(AllocationStrategy):
+    """
+    Attribue les places par niveau de priorité lu dans une colonne des contacts
+    (plus petite valeur servie en premier), en conservant l'ordre du fichier
+    à l'intérieur d'un même niveau.
+    """
+
+    def __init__(self, column, ascending=True):
+        self.column = column
+        self.ascending = ascending
+
+    def order_contacts(self, contacts_df):
+        return contacts_df.sort_values(self.column, ascending=self.ascending, kind="stable", na_position="last")
+
+class GroupStrategy(AllocationStrategy):
+    """
+    Regroupe les réservations de groupe : les contacts partageant la même
+    valeur de colonne reçoivent des fichiers de places consécutifs.
+    Les groupes sont servis dans l'ordre de leur première apparition.
+    """
+
+    def __init__(self, column):
+        self.column = column
+
+    def order_contacts(self, contacts_df):
+        codes, _ = pd.factorize(contacts_df[self.column], use_na_sentinel=False)
+        return contacts_df.iloc[np.argsort(codes, kind="stable")]
+
+class ShuffleStrategy(AllocationStrategy):
+    """Tirage au sort déterministe : la même graine donne toujours la même attribution."""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def order_contacts(self, contacts_df):
+        permutation = np.random.default_rng(self.seed).permutation(len(contacts_df))
+        return contacts_df.iloc[permutation]
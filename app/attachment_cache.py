@@ -0,0 +1,108 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.email_sender import encode_attachment_part
+
+# En dessous de ce nombre de fichiers, le coût de démarrage des processus dépasse le gain
+PROCESS_POOL_THRESHOLD = 8
+
+def encode_attachment_file(attachment_path):
+    """
+    Lit un fichier et retourne (empreinte sha256, partie MIME encodée).
+    Fonction de module pour pouvoir être exécutée dans un pool de processus.
+    """
+    with open(attachment_path, "rb") as attachment:
+        data = attachment.read()
+    return hashlib.sha256(data).hexdigest(), encode_attachment_part(data, os.path.basename(attachment_path))
+
+class AttachmentCache:
+    """
+    Cache des pièces jointes déjà encodées en partie MIME base64.
+    Les parties sont indexées par empreinte du contenu (et nom de fichier) ;
+    chaque chemin garde sa taille et sa date de modification pour détecter
+    un fichier remplacé. Les entrées les moins récemment utilisées sont
+    évincées au-delà de max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.parts = OrderedDict()
+        self.paths = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _lookup(self, attachment_path, stat):
+        entry = self.paths.get(attachment_path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size) or entry[2] not in self.parts:
+            return None
+        self.parts.move_to_end(entry[2])
+        return self.parts[entry[2]]
+
+    def _store(self, attachment_path, stat, digest, part):
+        key = (digest, os.path.basename(attachment_path))
+        with self.lock:
+            self.paths[attachment_path] = (stat.st_mtime_ns, stat.st_size, key)
+            if key not in self.parts:
+                self.parts[key] = part
+                self.size += len(part)
+                while self.size > self.max_bytes and len(self.parts) > 1:
+                    _, evicted = self.parts.popitem(last=False)
+                    self.size -= len(evicted)
+
+    def get(self, attachment_path):
+        """Retourne la partie MIME de la pièce jointe, en l'encodant si besoin."""
+        stat = os.stat(attachment_path)
+        with self.lock:
+            part = self._lookup(attachment_path, stat)
+        if part is not None:
+            return part
+        digest, part = encode_attachment_file(attachment_path)
+        self._store(attachment_path, stat, digest, part)
+        return part
+
+    def put(self, attachment_path, digest, part):
+        """Enregistre une partie déjà encodée ailleurs (par exemple lors du découpage d'un PDF)."""
+        self._store(attachment_path, os.stat(attachment_path), digest, part)
+
+    def _missing(self, attachment_paths):
+        """Couples (chemin, stat) des fichiers absents du cache ou modifiés depuis."""
+        todo = []
+        with self.lock:
+            for attachment_path in attachment_paths:
+                stat = os.stat(attachment_path)
+                if self._lookup(attachment_path, stat) is None:
+                    todo.append((attachment_path, stat))
+        return todo
+
+    def precompute(self, attachment_paths, max_workers=None):
+        """
+        Encode à l'avance toutes les pièces jointes pas encore en cache,
+        dans un pool de processus pour les gros volumes.
+        """
+        todo = self._missing(attachment_paths)
+        if not todo:
+            return
+        print(f"Log (attachment_cache): Encodage de {len(todo)} pièces jointes")
+        if len(todo) >= PROCESS_POOL_THRESHOLD:
+            context = multiprocessing.get_context("forkserver")
+            try:
+                with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+                    paths = [attachment_path for attachment_path, _ in todo]
+                    self._store_all(todo, pool.map(encode_attachment_file, paths, chunksize=8))
+                return
+            except BrokenProcessPool as e:
+                # Les fichiers déjà encodés restent en cache, le reste est encodé ici
+                print(f"Log (attachment_cache): Pool de processus indisponible ({e}), encodage local")
+                todo = self._missing(attachment_path for attachment_path, _ in todo)
+        self._store_all(todo, map(encode_attachment_file, [attachment_path for attachment_path, _ in todo]))
+
+    def _store_all(self, todo, results):
+        for (attachment_path, stat), (digest, part) in zip(todo, results):
+            self._store(attachment_path, stat, digest, part)
+
+# Cache partagé par toutes les campagnes du processus
+attachment_cache = AttachmentCache()
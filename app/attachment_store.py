@@ -0,0 +1,166 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+STORE_DIR = ".attachment_store"
+# Jeux de places non utilisés depuis plus longtemps que ceci : supprimés au prochain nettoyage
+STORE_MAX_AGE = 7 * 24 * 3600
+# Au-delà de cette taille totale des contenus, les jeux les plus anciens sont supprimés
+STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Délai avant qu'un contenu orphelin puisse être supprimé
+BLOB_GRACE_SECONDS = 3600
+# Suffixe du marqueur d'un contenu réutilisé, en attente de publication
+PENDING_SUFFIX = ".pending"
+
+def blob_path(root, digest):
+    return os.path.join(root, "blobs", digest[:2], digest)
+
+def write_blob(root, digest, data):
+    """
+    Écrit un contenu sous son empreinte s'il n'est pas déjà stocké (écriture
+    atomique). Retourne True si un nouveau contenu a été écrit.
+    Fonction de module pour pouvoir être appelée depuis un pool de processus.
+    """
+    path = blob_path(root, digest)
+    if os.path.exists(path):
+        # Le délai de grâce repart d'un marqueur à part : toucher le contenu changerait la date
+        # de modification de tous ses liens et invaliderait le cache des pièces jointes
+        with open(path + PENDING_SUFFIX, "a"):
+            pass
+        os.utime(path + PENDING_SUFFIX)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+def _link(source, target):
+    """Lien physique vers le contenu ; copie si le système de fichiers ne le permet pas."""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+class AttachmentStore:
+    """
+    Magasin de pièces jointes adressé par contenu.
+    Chaque fichier est stocké une seule fois sous son empreinte sha256
+    (blobs/). Un jeu de places validé est publié dans un dossier (sets/)
+    nommé d'après l'empreinte de la liste (nom, contenu) et contenant des liens
+    vers les blobs sous leur nom d'origine. Un dossier publié n'est jamais
+    modifié : deux opérateurs ne peuvent pas écraser les places l'un de
+    l'autre, et revalider les mêmes fichiers ne réécrit rien.
+    """
+
+    def __init__(self, root=STORE_DIR, max_age=STORE_MAX_AGE, max_bytes=STORE_MAX_BYTES):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @property
+    def sets_dir(self):
+        return os.path.join(self.root, "sets")
+
+    def add(self, data, digest=None):
+        """Stocke un contenu (bytes ou memoryview, sans copie) et retourne son empreinte."""
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        if write_blob(self.root, digest, data):
+            print(f"Log (attachment_store): Nouveau contenu {digest[:12]} ({len(data)} octets)")
+        return digest
+
+    def publish(self, entries):
+        """
+        Publie un jeu de places à partir de couples (nom de fichier, empreinte)
+        déjà stockés. Retourne (dossier, chemins dans l'ordre des entrées).
+        Si le même jeu a déjà été publié, son dossier est simplement réutilisé.
+        """
+        entries = [(os.path.basename(name), digest) for name, digest in entries]
+        # Un nom en double garde le dernier contenu, comme l'ancien dossier partagé
+        files = dict(entries)
+        set_key = hashlib.sha256(
+            "\n".join(f"{name}\0{digest}" for name, digest in sorted(files.items())).encode("utf-8")
+        ).hexdigest()[:16]
+        folder = os.path.join(self.sets_dir, set_key)
+        with self.lock:
+            if os.path.isdir(folder):
+                os.utime(folder)
+                print(f"Log (attachment_store): Jeu de places {set_key} déjà publié")
+            else:
+                os.makedirs(self.sets_dir, exist_ok=True)
+                tmp_folder = os.path.join(self.sets_dir, f".tmp-{uuid.uuid4().hex}")
+                os.makedirs(tmp_folder)
+                for name, digest in files.items():
+                    _link(blob_path(self.root, digest), os.path.join(tmp_folder, name))
+                try:
+                    os.rename(tmp_folder, folder)
+                except OSError:
+                    # Publié entre-temps par un autre processus : même contenu, on garde le sien
+                    shutil.rmtree(tmp_folder, ignore_errors=True)
+                print(f"Log (attachment_store): Jeu de places {set_key} publié ({len(files)} fichiers)")
+        return folder, [os.path.join(folder, name) for name, _ in entries]
+
+    def _sweep_blobs(self):
+        """Supprime les contenus plus référencés par aucun jeu ; retourne la taille des contenus référencés."""
+        total = 0
+        blobs_dir = os.path.join(self.root, "blobs")
+        if not os.path.isdir(blobs_dir):
+            return 0
+        now = time.time()
+        for prefix in os.scandir(blobs_dir):
+            entries = {entry.name: entry for entry in os.scandir(prefix.path)}
+            for name, blob in entries.items():
+                if name.endswith(PENDING_SUFFIX):
+                    # Marqueur dont le contenu a déjà disparu
+                    if name[:-len(PENDING_SUFFIX)] not in entries and now - blob.stat().st_mtime > BLOB_GRACE_SECONDS:
+                        os.remove(blob.path)
+                    continue
+                stat = blob.stat()
+                marker = entries.get(name + PENDING_SUFFIX)
+                last_used = max(stat.st_mtime, marker.stat().st_mtime) if marker is not None else stat.st_mtime
+                expired = now - last_used > BLOB_GRACE_SECONDS
+                # Un seul lien : plus aucun dossier de jeu ne pointe vers ce contenu.
+                # Les contenus récents sont gardés : ils peuvent être en attente de publication
+                if stat.st_nlink > 1:
+                    total += stat.st_size
+                elif expired:
+                    os.remove(blob.path)
+                if marker is not None and expired:
+                    os.remove(marker.path)
+        return total
+
+    def gc(self, keep=()):
+        """
+        Nettoie le magasin : jeux inutilisés depuis max_age, puis contenus
+        orphelins, puis jeux les plus anciens tant que la taille dépasse
+        max_bytes. Les dossiers de `keep` (campagnes en cours) sont conservés.
+        """
+        if not os.path.isdir(self.sets_dir):
+            return
+        keep = {os.path.abspath(folder) for folder in keep}
+        with self.lock:
+            now = time.time()
+            sets = sorted(
+                (entry for entry in os.scandir(self.sets_dir) if entry.is_dir() and os.path.abspath(entry.path) not in keep),
+                key=lambda entry: entry.stat().st_mtime
+            )
+            removed = 0
+            while sets and now - sets[0].stat().st_mtime > self.max_age:
+                shutil.rmtree(sets.pop(0).path, ignore_errors=True)
+                removed += 1
+            total = self._sweep_blobs()
+            while sets and total > self.max_bytes:
+                shutil.rmtree(sets.pop(0).path, ignore_errors=True)
+                removed += 1
+                total = self._sweep_blobs()
+        if removed:
+            print(f"Log (attachment_store): {removed} jeux de places supprimés, {total / 1024 / 1024:.1f} Mo conservés")
+
+# Magasin partagé par toutes les sessions du processus
+attachment_store = AttachmentStore()
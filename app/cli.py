@@ -0,0 +1,223 @@
+"""
+Envoi d'une campagne en ligne de commande, sans Streamlit (serveur, cron).
+
+Usage :
+    python main.py send --contacts membres.csv --email-column Mail --places places/ \
+        --subject "Ta place pour le match" --body email.html --username club@gmail.com
+
+Le mot de passe est lu dans la variable d'environnement SMTP_PASSWORD
+(voir --password-env). D'autres comptes d'envoi peuvent être fournis dans un
+CSV (--accounts) dont chaque ligne nomme la variable de son mot de passe.
+Le rapport rapport_envoi.csv est écrit au fil des envois.
+Avec --dry-run, les messages sont construits mais écrits dans un fichier mbox
+ou un dossier de .eml au lieu d'être envoyés (aucun mot de passe nécessaire).
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from app.accounts import SenderAccount, QUOTA_WINDOW_SECONDS
+from app.dispatcher import dispatch_emails
+from app.email_sender import CORRECT_EMOJIS_STYLE, DryRunOutput, check_smtp_connection
+from app.instrumentation import Tracer, JsonlTraceSink
+from app.journal import SendJournal, campaign_id_for
+from app.pdf_split import split_ticket_bundle
+from app.templating import compile_template
+from app.utils import load_contacts_file, read_contacts_header, create_distribution_mapping, lookup_contact_values
+from app.validation import validate_contacts, parse_domain_list
+
+REPORT_FIELDS = ["email", "fichier", "statut", "compte"]
+# Colonnes ajoutées au rapport d'une simulation
+DRY_RUN_FIELDS = ["taille_octets", "construction_ms"]
+# Corps personnalisés rendus par tranches au fil des envois
+RENDER_CHUNK_SIZE = 500
+
+class LocalContactsFile(io.BytesIO):
+    """Fichier contacts local présenté comme un upload Streamlit (nom + contenu)."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="PARISII - Distribution des places")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    send = subparsers.add_parser("send", help="Envoyer une campagne sans interface")
+    send.add_argument("--contacts", required=True, help="Fichier de contacts (CSV/Excel)")
+    send.add_argument("--email-column", required=True, help="Colonne contenant les adresses email")
+    send.add_argument("--places", required=True, help="Dossier des fichiers de places, ou PDF unique avec une place par page")
+    send.add_argument("--subject", required=True, help="Objet de l'email")
+    send.add_argument("--body", required=True, help="Fichier HTML du contenu de l'email, avec d'éventuels champs {{colonne}}")
+    send.add_argument("--plain", action="store_true", help="Le contenu est du texte brut et non du HTML")
+    send.add_argument("--smtp-server", default="smtp.gmail.com")
+    send.add_argument("--smtp-port", type=int, default=587)
+    send.add_argument("--username", required=True, help="Adresse email d'envoi")
+    send.add_argument("--password-env", default="SMTP_PASSWORD", help="Variable d'environnement contenant le mot de passe")
+    send.add_argument("--daily-quota", type=int, default=0, help="Quota journalier du compte, 0 = illimité")
+    send.add_argument("--accounts", default=None, help="CSV de comptes supplémentaires (username,password_env[,daily_quota])")
+    send.add_argument("--workers", type=int, default=4, help="Envois simultanés")
+    send.add_argument("--rate", type=int, default=60, help="Débit maximum (emails/minute), 0 = illimité")
+    send.add_argument("--max-attempts", type=int, default=3, help="Tentatives maximum pour un échec temporaire")
+    send.add_argument("--allowed-domains", default="", help="Domaines autorisés, séparés par des virgules")
+    send.add_argument("--blocked-domains", default="", help="Domaines bloqués, séparés par des virgules")
+    send.add_argument("--resume", action="store_true", help="Ne pas renvoyer les emails déjà confirmés dans le journal")
+    send.add_argument("--report", default="rapport_envoi.csv", help="Rapport d'envoi (CSV)")
+    send.add_argument("--trace", default=None, help="Fichier JSONL des temps par étape")
+    send.add_argument("--dry-run", default=None, metavar="SORTIE", help="Simulation sans envoi : messages écrits dans SORTIE (.mbox) ou dans le dossier SORTIE (un .eml par message)")
+    return parser
+
+def read_account_specs(args):
+    """
+    Compte principal puis comptes du fichier --accounts, sous la forme
+    (adresse, variable d'environnement du mot de passe, quota journalier).
+    """
+    specs = [(args.username, args.password_env, args.daily_quota)]
+    if args.accounts:
+        with open(args.accounts, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                specs.append((row["username"], row["password_env"], int(row.get("daily_quota") or 0)))
+    return specs
+
+def build_accounts(args, specs, journal):
+    """Crée les SenderAccount, avec le quota déjà consommé sur les dernières 24 h."""
+    quota_since = time.time() - QUOTA_WINDOW_SECONDS
+    return [
+        SenderAccount(
+            username, os.environ.get(password_env, ""), args.smtp_server, args.smtp_port,
+            daily_quota=daily_quota or None, rate_per_minute=args.rate or None,
+            max_workers=args.workers, already_sent=journal.sent_since(username, quota_since)
+        )
+        for username, password_env, daily_quota in specs
+    ]
+
+def run_send(args):
+    specs = read_account_specs(args)
+    for username, password_env, _ in specs:
+        if args.dry_run is None and password_env not in os.environ:
+            print(f"Erreur : la variable d'environnement {password_env} n'est pas définie ({username}).", file=sys.stderr)
+            return 2
+
+    with open(args.body, encoding="utf-8") as f:
+        body = f.read()
+    is_html = not args.plain
+    if is_html:
+        body = CORRECT_EMOJIS_STYLE + "\n" + body
+    template = compile_template(body, is_html=is_html)
+
+    # Colonne email et colonnes des champs {{colonne}} du modèle
+    contacts_file = LocalContactsFile(args.contacts)
+    header = read_contacts_header(contacts_file)
+    usecols = [args.email_column] + [c for c in template.columns if c in header and c != args.email_column]
+    contacts_raw = load_contacts_file(contacts_file, usecols=usecols, dtype={args.email_column: "string"})
+    contacts_df, rejected_df = validate_contacts(
+        contacts_raw[[args.email_column]].rename(columns={args.email_column: "email"}),
+        allowed_domains=parse_domain_list(args.allowed_domains),
+        blocked_domains=parse_domain_list(args.blocked_domains)
+    )
+    if os.path.isfile(args.places):
+        places_folder, places_paths = split_ticket_bundle(args.places)
+    else:
+        places_paths = sorted(
+            os.path.join(args.places, f) for f in os.listdir(args.places) if f.lower().endswith(".pdf")
+        )
+        places_folder = args.places
+    mapping = create_distribution_mapping(contacts_df, places_paths)
+    values = None
+    if template.has_fields:
+        values = lookup_contact_values(contacts_raw, args.email_column, mapping["email"].tolist(), template.columns)
+
+    campaign_id = campaign_id_for(mapping, args.subject)
+    tracer = Tracer(JsonlTraceSink(args.trace)) if args.trace else None
+    dry_run = None
+    if args.dry_run:
+        try:
+            dry_run = DryRunOutput(args.dry_run)
+        except OSError as e:
+            print(f"Erreur : sortie de la simulation impossible : {e}", file=sys.stderr)
+            return 2
+    counts = {"sent": 0, "failed": 0, "skipped": 0}
+
+    with open(args.report, "w", encoding="utf-8", newline="") as report_file, SendJournal() as journal:
+        report = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS + (DRY_RUN_FIELDS if dry_run else []))
+        report.writeheader()
+
+        def write_row(email, file, status, sender="", **extra):
+            report.writerow({"email": email, "fichier": file, "statut": status, "compte": sender, **extra})
+            report_file.flush()
+
+        # Lignes sans envoi : écrites immédiatement, sans passer par le dispatcher
+        for email, reason in rejected_df[["email", "motif"]].itertuples(index=False, name=None):
+            write_row(email, "Non attribué", f"Rejeté: {reason}")
+            counts["skipped"] += 1
+        already_sent = journal.confirmed(campaign_id) if args.resume else set()
+        accounts = build_accounts(args, specs, journal)
+        if dry_run is None:
+            # Capacités du serveur relevées avant de construire les messages ; la connexion
+            # vérifiée est reprise par le premier envoi du compte
+            for account in accounts:
+                connection_ok, message = check_smtp_connection(
+                    account.smtp_server, account.smtp_port, account.username, account.password, keep_connection=True
+                )
+                if not connection_ok:
+                    print(f"Attention : vérification du compte {account.username} impossible : {message}", file=sys.stderr)
+
+        def iter_jobs():
+            """
+            Génère les envois à faire à partir de la distribution, sans les matérialiser.
+            Les corps personnalisés sont rendus par tranches de RENDER_CHUNK_SIZE lignes.
+            """
+            bodies = []
+            bodies_start = 0
+            for index, email, file in mapping.itertuples(name=None):
+                if email == "Non attribué" or file == "Non attribué":
+                    write_row(email, file, "Aucun envoi (place non attribuée)")
+                    counts["skipped"] += 1
+                elif (email, file) in already_sent:
+                    write_row(email, file, "Succès (envoi précédent)")
+                    counts["sent"] += 1
+                else:
+                    job = {"index": index, "email": email, "file": file, "attachment_path": os.path.join(places_folder, file)}
+                    if values is not None:
+                        if not bodies_start <= index < bodies_start + len(bodies):
+                            bodies_start = index
+                            bodies = template.render_many(values.iloc[index:index + RENDER_CHUNK_SIZE]).tolist()
+                        job["body"] = bodies[index - bodies_start]
+                    yield job
+
+        results = dispatch_emails(
+            iter_jobs(), args.smtp_server, args.smtp_port, args.username, accounts[0].password, args.subject, template.text,
+            is_html=is_html, max_workers=args.workers, rate_per_minute=args.rate or None,
+            max_attempts=args.max_attempts, tracer=tracer, accounts=accounts, dry_run=dry_run
+        )
+        for job, success, msg in results:
+            if dry_run is None:
+                journal.record(campaign_id, job["email"], job["file"], success, msg, sender=job.get("sender"))
+                write_row(job["email"], job["file"], "Succès" if success else f"Erreur: {msg}", job.get("sender", ""))
+            else:
+                write_row(
+                    job["email"], job["file"], "Succès (simulation)" if success else f"Erreur: {msg}", job.get("sender", ""),
+                    taille_octets=job.get("size", ""),
+                    construction_ms=f"{job['build_time'] * 1000:.2f}" if "build_time" in job else ""
+                )
+            counts["sent" if success else "failed"] += 1
+
+    if tracer is not None:
+        tracer.close()
+    if dry_run is not None:
+        dry_run.close()
+        print(f"Simulation terminée : {dry_run.describe()}. Messages : {args.dry_run}")
+    sent_label = "simulés" if dry_run is not None else "envoyés"
+    print(f"Envoi terminé : {counts['sent']} {sent_label}, {counts['failed']} en échec, {counts['skipped']} sans envoi. Rapport : {args.report}")
+    return 1 if counts["failed"] else 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "send":
+        return run_send(args)
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from app.email_sender import SMTPSession, CampaignMessageBuilder, smtp_error_code, get_smtp_capabilities
+from app.accounts import SenderAccount, AccountPool
+from app.attachment_cache import attachment_cache
+from app.instrumentation import NULL_TRACER
+from app.metrics import SendMetrics
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+CANCELLED = "cancelled"
+
+def classify_error(error):
+    """
+    Classe une erreur d'envoi : TRANSIENT (4xx, connexion perdue, timeout)
+    peut être retentée, PERMANENT (5xx, fichier manquant...) va directement au rapport.
+    """
+    code = smtp_error_code(error)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return PERMANENT
+
+def dispatch_emails(jobs, smtp_server, smtp_port, username, password, subject, body,
+                    is_html=False, max_workers=4, throttle=0.0,
+                    rate_per_minute=None, max_attempts=3, retry_delay=2.0, cancel_event=None,
+                    tracer=None, accounts=None, dry_run=None, metrics=None):
+    """
+    Envoie les emails en parallèle avec max_workers workers SMTP.
+    Chaque worker possède sa propre SMTPSession. Les résultats sont renvoyés
+    au fil de l'eau, dans l'ordre de fin d'envoi, sous la forme (job, success, msg).
+    `jobs` est un itérable, consommé au fil de l'eau, de dicts contenant au moins
+    "email" et "attachment_path", et éventuellement "body" (corps personnalisé) ;
+    le dispatcher y ajoute "attempts", "duration" (durée de la dernière
+    tentative, en s) et "sender" (compte utilisé).
+    `throttle` est une pause optionnelle (en secondes) après chaque envoi d'un worker.
+    `rate_per_minute` active un limiteur de débit adaptatif partagé par les workers.
+    Les échecs temporaires sont remis en file avec un délai exponentiel
+    (retry_delay, 2 x retry_delay, ...) jusqu'à max_attempts tentatives.
+    Si `cancel_event` est levé, plus aucun envoi n'est démarré : seuls les
+    résultats des envois déjà en cours sont encore renvoyés.
+    Un Tracer optionnel mesure chaque étape de chaque message (voir app.instrumentation).
+    `accounts` (liste de SenderAccount) remplace le compte unique
+    smtp_server/username/password : chaque compte a ses propres workers,
+    connexions, débit et quota, et les envois d'un compte désactivé (quota
+    atteint, identifiants refusés) sont repris par les autres (voir app.accounts).
+    Avec `dry_run` (DryRunOutput), chaque message est construit comme pour un
+    envoi réel puis écrit dans la sortie de simulation : aucune connexion SMTP,
+    pas de limite de débit. Les jobs reçoivent aussi "size" (taille du message
+    en octets) et "build_time" (temps de construction, en s).
+    Un SendMetrics optionnel reçoit le détail des tentatives, des résultats et
+    des files d'attente pour le suivi en direct (voir app.metrics).
+    """
+    tracer = tracer or NULL_TRACER
+    metrics = metrics if metrics is not None else SendMetrics(0)
+    if accounts is None:
+        accounts = [SenderAccount(username, password, smtp_server, smtp_port, rate_per_minute=rate_per_minute, max_workers=max_workers)]
+    account_pool = AccountPool(accounts)
+    # Par compte : squelette MIME (l'expéditeur y est fixé, l'encodage suit les capacités
+    # du serveur relevées à la vérification), pool de workers et sessions par thread
+    lanes = {}
+    sessions = []
+    sessions_lock = threading.Lock()
+    for i, account in enumerate(account_pool.accounts):
+        lanes[account] = (
+            CampaignMessageBuilder(
+                account.username, subject, body, is_html=is_html, attachment_cache=attachment_cache, tracer=tracer,
+                capabilities=get_smtp_capabilities(account.smtp_server, account.smtp_port)
+            ),
+            ThreadPoolExecutor(max_workers=account.max_workers, thread_name_prefix=f"smtp-worker-{i}"),
+            threading.local(),
+        )
+
+    def worker(account, job):
+        builder, _, local = lanes[account]
+        session = getattr(local, "session", None)
+        if session is None and dry_run is None:
+            session = SMTPSession(account.smtp_server, account.smtp_port, account.username, account.password, tracer=tracer)
+            local.session = session
+            with sessions_lock:
+                sessions.append(session)
+        # L'attente d'un jeton est interrompue par l'annulation
+        if account.limiter is not None and dry_run is None and not account.limiter.acquire(cancel_event):
+            return account, job, CANCELLED, None
+        if cancel_event is not None and cancel_event.is_set():
+            return account, job, CANCELLED, None
+        job["attempts"] = job.get("attempts", 0) + 1
+        started = time.perf_counter()
+        try:
+            with tracer.span("message", email=job["email"]):
+                msg_bytes = builder.build_bytes(job["email"], job["attachment_path"], job.get("body"))
+                job["build_time"] = time.perf_counter() - started
+                job["size"] = len(msg_bytes)
+                if dry_run is not None:
+                    dry_run.write(job["email"], msg_bytes, job["build_time"])
+                else:
+                    session.sendmail(account.username, [job["email"]], msg_bytes, builder.mail_options)
+            job["duration"] = time.perf_counter() - started
+        except Exception as e:
+            job["duration"] = time.perf_counter() - started
+            kind = classify_error(e)
+            if kind == TRANSIENT and account.limiter is not None:
+                account.limiter.penalize()
+            print(f"Log (dispatcher): Erreur ({kind}) lors de l'envoi à {job['email']} depuis {account.username} (tentative {job['attempts']}): {e}")
+            return account, job, kind, e
+        finally:
+            if throttle and dry_run is None:
+                time.sleep(throttle)
+        if account.limiter is not None and dry_run is None:
+            account.limiter.reward()
+        if dry_run is not None:
+            print(f"Log (dispatcher): Email simulé pour {job['email']} ({job['size']} octets)")
+        else:
+            print(f"Log (dispatcher): Email envoyé à {job['email']}")
+        return account, job, None, None
+
+    def finish(job, success, msg):
+        """Résultat définitif d'un envoi, compté dans les indicateurs."""
+        metrics.record_done()
+        return job, success, msg
+
+    def submit(job, now):
+        """Confie le job au meilleur compte disponible ; retourne False s'il n'y en a aucun."""
+        account = account_pool.pick(now)
+        if account is None:
+            return False
+        account.in_flight += 1
+        job["sender"] = account.username
+        pending.add(lanes[account][1].submit(worker, account, job))
+        return True
+
+    print(f"Log (dispatcher): Envoi avec {len(accounts)} compte(s), {sum(a.max_workers for a in accounts)} workers")
+    # Les jobs sont consommés au fil de l'eau : au plus `capacity` envois soumis par compte
+    jobs = iter(jobs)
+    exhausted = False
+    pending = set()
+    # File des nouvelles tentatives : (instant de relance, ordre d'insertion, job)
+    retry_queue = []
+    sequence = itertools.count()
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                exhausted = True
+                retry_queue.clear()
+                for future in pending:
+                    future.cancel()
+            if account_pool.exhausted:
+                # Plus aucun compte utilisable : les envois restants échouent sans être tentés
+                reason = f"Aucun compte d'envoi disponible ({account_pool.describe()})"
+                while retry_queue:
+                    yield finish(heapq.heappop(retry_queue)[2], False, reason)
+                if not exhausted:
+                    for job in jobs:
+                        yield finish(job, False, reason)
+                    exhausted = True
+            now = time.monotonic()
+            while retry_queue and retry_queue[0][0] <= now and submit(retry_queue[0][2], now):
+                heapq.heappop(retry_queue)
+            while not exhausted and account_pool.pick(now) is not None:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    submit(job, now)
+            if not pending and not retry_queue and exhausted:
+                break
+            # Une relance en attente d'un compte libre attend la fin d'un envoi, pas son échéance
+            retry_at = retry_queue[0][0] if retry_queue and retry_queue[0][0] > now else None
+            wakeups = [t for t in (retry_at, account_pool.next_wakeup(now)) if t is not None]
+            timeout = min(wakeups) - now if wakeups else None
+            if cancel_event is not None or not pending:
+                # Réveil régulier pour prendre en compte une annulation ou un compte de nouveau disponible
+                timeout = 0.5 if timeout is None else min(timeout, 0.5)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            # Envois réellement en cours : au plus max_workers par compte, le reste attend un worker
+            metrics.update_queues(sum(min(a.in_flight, a.max_workers) for a in accounts), len(retry_queue))
+            for future in done:
+                if future.cancelled():
+                    continue
+                account, job, kind, error = future.result()
+                if kind == CANCELLED:
+                    account.in_flight -= 1
+                    continue
+                metrics.record_attempt(error)
+                if kind is None:
+                    account.on_success()
+                    yield finish(job, True, "Email envoyé")
+                # Avec un seul compte, pas de suspension : le limiteur et les relances suffisent
+                elif account.on_failure(error, kind == TRANSIENT, suspend=len(lanes) > 1):
+                    # Échec lié au compte : l'envoi est repris tout de suite par un autre compte
+                    job["attempts"] -= 1
+                    heapq.heappush(retry_queue, (time.monotonic(), next(sequence), job))
+                elif kind == TRANSIENT and job["attempts"] < max_attempts:
+                    delay = retry_delay * 2 ** (job["attempts"] - 1)
+                    heapq.heappush(retry_queue, (time.monotonic() + delay, next(sequence), job))
+                else:
+                    yield finish(job, False, str(error))
+    finally:
+        metrics.update_queues(0, 0)
+        # Annule les envois pas encore démarrés si l'appelant s'arrête en cours de route
+        for _, executor, _ in lanes.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        for session in sessions:
+            session.close()
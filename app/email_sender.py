@@ -1,51 +1,513 @@
+import base64
+import binascii
+import hashlib
+import itertools
+import mailbox
+import os
+import re
+import secrets
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
+import threading
+import time
+from email import policy
+from email.utils import formatdate, make_msgid
+from app.instrumentation import NULL_TRACER
 
-def check_smtp_connection(smtp_server, smtp_port, username, password):
+SMTP_POLICY = policy.SMTP
+
+# Longueur maximale d'une ligne SMTP hors fin de ligne (RFC 5321)
+SMTP_MAX_LINE = 998
+# Une connexion ouverte par la vérification peut être reprise par l'envoi pendant ce délai (s)
+WARM_CONNECTION_MAX_AGE = 120
+_LINE_BREAK = re.compile(rb"\r\n|\r|\n")
+
+# Les emojis collés depuis Gmail sont des images : on les ramène à la taille du texte
+CORRECT_EMOJIS_STYLE = """
+        <style>
+            img {
+                height: 1em !important;
+                width: 1em !important;
+            }
+        </style>
+        """
+
+def format_size(num_bytes):
+    """Taille lisible : en Mo à partir de 1 Mo, en Ko en dessous."""
+    if num_bytes >= 1024 * 1024:
+        return f"{num_bytes / 1024 / 1024:.1f} Mo"
+    return f"{num_bytes / 1024:.1f} Ko"
+
+class MessageTooLargeError(ValueError):
+    """Message plus gros que la taille maximale annoncée par le serveur (extension SIZE)."""
+
+class SMTPCapabilities:
+    """
+    Extensions annoncées par le serveur après STARTTLS (réponse EHLO) et
+    adresse IP résolue. Relevées à chaque connexion et gardées en cache par
+    serveur : le message est construit et contrôlé en fonction du serveur
+    avant d'être transmis.
+    """
+
+    def __init__(self, features, address=None):
+        size = features.get("size", "").strip()
+        self.max_size = int(size) if size.isdigit() and int(size) > 0 else None
+        self.pipelining = "pipelining" in features
+        self.eightbitmime = "8bitmime" in features
+        self.smtputf8 = "smtputf8" in features
+        self.address = address
+
+    def describe(self):
+        parts = [f"taille max {format_size(self.max_size)}"] if self.max_size else []
+        parts += [name for name, supported in (
+            ("PIPELINING", self.pipelining), ("8BITMIME", self.eightbitmime), ("SMTPUTF8", self.smtputf8)
+        ) if supported]
+        if self.address:
+            parts.append(f"adresse {self.address}")
+        return ", ".join(parts) or "aucune extension"
+
+# Capacités par (serveur, port), partagées par toutes les sessions du processus
+_capabilities = {}
+# Connexions authentifiées gardées par la vérification :
+# (serveur, port, compte, empreinte du mot de passe) -> (connexion, ouverture)
+_warm_connections = {}
+_warm_lock = threading.Lock()
+
+def get_smtp_capabilities(smtp_server, smtp_port):
+    """Capacités du serveur relevées lors d'une connexion précédente, ou None."""
+    return _capabilities.get((smtp_server, int(smtp_port)))
+
+class _AddressedSMTP(smtplib.SMTP):
+    """
+    Connexion SMTP ouverte vers une adresse IP déjà résolue. smtplib présente
+    à STARTTLS (SNI) le nom d'hôte qu'il a mémorisé (attribut _host) : connect()
+    est surchargé pour que ce soit le nom du serveur et non son adresse.
+    """
+
+    def __init__(self, server_hostname, timeout):
+        self.server_hostname = server_hostname
+        super().__init__(timeout=timeout)
+
+    def connect(self, host="localhost", port=0, source_address=None):
+        reply = super().connect(host, port, source_address)
+        self._host = self.server_hostname
+        return reply
+
+def _connect(smtp_server, smtp_port, timeout, address=None):
+    if address:
+        server = _AddressedSMTP(smtp_server, timeout)
+        try:
+            code, msg = server.connect(address, smtp_port)
+            if code == 220:
+                return server
+            server.close()
+        except OSError:
+            server.close()
+        print(f"Log (email_sender): Adresse {address} injoignable, nouvelle résolution de {smtp_server}")
+    return smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+
+def open_smtp_connection(smtp_server, smtp_port, username, password, timeout=10, tracer=None):
+    """
+    Ouvre une connexion authentifiée (STARTTLS + login) et met à jour les
+    capacités du serveur en cache. L'adresse déjà résolue est réutilisée, le
+    nom n'est résolu à nouveau que si elle ne répond plus.
+    """
+    tracer = tracer or NULL_TRACER
+    capabilities = get_smtp_capabilities(smtp_server, smtp_port)
+    with tracer.span("connect"):
+        server = _connect(smtp_server, smtp_port, timeout, capabilities.address if capabilities else None)
+    try:
+        with tracer.span("starttls"):
+            server.starttls()
+        with tracer.span("login"):
+            server.login(username, password)
+    except Exception:
+        server.close()
+        raise
+    try:
+        address = server.sock.getpeername()[0]
+    except (AttributeError, OSError):
+        address = None
+    _capabilities[(smtp_server, int(smtp_port))] = SMTPCapabilities(server.esmtp_features, address)
+    return server
+
+def _quit(server):
     try:
-        print(f"Log (email_sender): Connexion à {smtp_server}:{smtp_port} avec {username}")
-        server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
-        server.starttls()
-        server.login(username, password)
         server.quit()
-        print("Log (email_sender): Connexion SMTP établie avec succès.")
-        return True, "Connexion réussie"
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+def _warm_key(smtp_server, smtp_port, username, password):
+    # Le mot de passe fait partie de la clé : une autre session ne reprend la connexion
+    # authentifiée qu'avec les mêmes identifiants
+    return (smtp_server, int(smtp_port), username, hashlib.sha256(password.encode("utf-8")).hexdigest())
+
+def _close_expired_warm_connections():
+    """Ferme les connexions gardées qui n'ont pas été reprises à temps."""
+    now = time.monotonic()
+    with _warm_lock:
+        expired = [key for key, (_, opened_at) in _warm_connections.items() if now - opened_at >= WARM_CONNECTION_MAX_AGE]
+        servers = [_warm_connections.pop(key)[0] for key in expired]
+    for server in servers:
+        _quit(server)
+
+def take_warm_connection(smtp_server, smtp_port, username, password):
+    """
+    Reprend la connexion gardée par la vérification pour ces identifiants si
+    elle est récente et répond encore ; sinon retourne None.
+    """
+    _close_expired_warm_connections()
+    with _warm_lock:
+        entry = _warm_connections.pop(_warm_key(smtp_server, smtp_port, username, password), None)
+    if entry is None:
+        return None
+    server, _ = entry
+    try:
+        if server.noop()[0] == 250:
+            return server
+    except (smtplib.SMTPException, OSError):
+        pass
+    server.close()
+    return None
+
+def check_smtp_connection(smtp_server, smtp_port, username, password, keep_connection=False):
+    """
+    Vérifie les identifiants et relève les capacités du serveur.
+    Avec keep_connection, la connexion authentifiée reste ouverte pour être
+    reprise par le premier envoi du compte (voir take_warm_connection).
+    """
+    try:
+        print(f"Log (email_sender): Connexion à {smtp_server}:{smtp_port} avec {username}")
+        server = open_smtp_connection(smtp_server, smtp_port, username, password)
+        capabilities = get_smtp_capabilities(smtp_server, smtp_port)
+        if keep_connection:
+            _close_expired_warm_connections()
+            key = _warm_key(smtp_server, smtp_port, username, password)
+            with _warm_lock:
+                previous = _warm_connections.pop(key, None)
+                _warm_connections[key] = (server, time.monotonic())
+            if previous is not None:
+                _quit(previous[0])
+            # Fermée à l'expiration même si aucun envoi ni vérification ne suit
+            timer = threading.Timer(WARM_CONNECTION_MAX_AGE, _close_expired_warm_connections)
+            timer.daemon = True
+            timer.start()
+        else:
+            _quit(server)
+        print(f"Log (email_sender): Connexion SMTP établie avec succès ({capabilities.describe()}).")
+        return True, f"Connexion réussie ({capabilities.describe()})"
     except Exception as e:
         print(f"Log (email_sender): Erreur de connexion SMTP: {e}")
         return False, str(e)
 
-def send_email_message(smtp_server, smtp_port, username, password, recipient, subject, body, attachment_path, is_html=False):
-    try:
-        print(f"Log (email_sender): Préparation de l'email pour {recipient}")
-        # Créer le message
-        msg = MIMEMultipart()
-        msg["From"] = username
-        msg["To"] = recipient
-        msg["Subject"] = subject
-        
+def smtp_error_code(error):
+    """
+    Retourne le code de réponse SMTP porté par une exception smtplib,
+    ou None si l'erreur ne provient pas d'une réponse du serveur.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return max(codes) if codes else None
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    return None
+
+class SMTPSession:
+    """
+    Session SMTP persistante : une seule connexion authentifiée (STARTTLS + login)
+    est réutilisée pour tous les envois d'une campagne.
+    La connexion est rétablie de façon transparente si le serveur coupe la liaison
+    (SMTPServerDisconnected, code 421) ou après max_messages_per_connection envois.
+    Un Tracer optionnel mesure les étapes connect, starttls, login et data.
+    """
+
+    def __init__(self, smtp_server, smtp_port, username, password, timeout=10,
+                 max_messages_per_connection=None, max_reconnects=2, tracer=None):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_messages_per_connection = max_messages_per_connection
+        self.max_reconnects = max_reconnects
+        self.tracer = tracer or NULL_TRACER
+        self.server = None
+        self.messages_on_connection = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        self.close()
+        server = take_warm_connection(self.smtp_server, self.smtp_port, self.username, self.password)
+        if server is not None:
+            print(f"Log (email_sender): Reprise de la connexion vérifiée pour {self.username}")
+        else:
+            print(f"Log (email_sender): Ouverture de la session SMTP {self.smtp_server}:{self.smtp_port}")
+            server = open_smtp_connection(
+                self.smtp_server, self.smtp_port, self.username, self.password, timeout=self.timeout, tracer=self.tracer
+            )
+        self.server = server
+        self.messages_on_connection = 0
+
+    def close(self):
+        if self.server is None:
+            return
+        # La connexion est peut-être déjà fermée côté serveur
+        _quit(self.server)
+        self.server = None
+
+    def _connection_lost(self, error):
+        """Indique si l'erreur justifie une reconnexion plutôt qu'un échec."""
+        if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError)):
+            return True
+        return smtp_error_code(error) == 421
+
+    def _deliver(self, send):
+        limit = self.max_messages_per_connection
+        if self.server is not None and limit is not None and self.messages_on_connection >= limit:
+            print("Log (email_sender): Limite de messages par connexion atteinte, reconnexion.")
+            self.connect()
+        attempt = 0
+        while True:
+            try:
+                if self.server is None:
+                    self.connect()
+                with self.tracer.span("data"):
+                    send(self.server)
+                self.messages_on_connection += 1
+                return
+            except Exception as e:
+                if not self._connection_lost(e) or attempt >= self.max_reconnects:
+                    raise
+                attempt += 1
+                print(f"Log (email_sender): Connexion perdue ({e}), reconnexion {attempt}/{self.max_reconnects}")
+                self.close()
+
+    def sendmail(self, from_addr, to_addrs, msg_bytes, mail_options=()):
+        """Envoie un message déjà sérialisé (voir CampaignMessageBuilder et son attribut mail_options)."""
+        self._deliver(lambda server: server.sendmail(from_addr, to_addrs, msg_bytes, mail_options))
+
+def encode_attachment_part(data, filename):
+    """Partie MIME d'une pièce jointe (en-têtes + contenu base64), en octets."""
+    payload = base64.encodebytes(data).replace(b"\n", b"\r\n")
+    headers = (
+        "Content-Type: application/octet-stream\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Transfer-Encoding: base64\r\n"
+        + SMTP_POLICY.fold("Content-Disposition", f'attachment; filename="{filename}"')
+    )
+    return headers.encode("ascii") + b"\r\n" + payload
+
+class CampaignMessageBuilder:
+    """
+    Construit les messages d'une campagne à partir d'un squelette MIME préparé une fois.
+    Les en-têtes communs et la partie texte/HTML (encodée une seule fois) sont
+    sérialisés à la création ; seuls le destinataire, le Message-ID, la date et
+    la pièce jointe sont ajoutés pour chaque message, directement en octets.
+    Avec un AttachmentCache, les pièces jointes déjà encodées sont réutilisées telles quelles.
+    Un Tracer optionnel mesure les étapes attachment et build.
+    Les SMTPCapabilities du serveur, si elles sont connues, permettent d'envoyer
+    le corps en 8 bits (8BITMIME) et de refuser un message trop gros (SIZE)
+    avant de le transmettre ; mail_options est à passer à SMTP.sendmail.
+    """
+
+    def __init__(self, username, subject, body, is_html=False, attachment_cache=None, tracer=None, capabilities=None):
+        self.username = username
+        self.attachment_cache = attachment_cache
+        self.tracer = tracer or NULL_TRACER
+        self.boundary = f"==============={secrets.token_hex(16)}=="
+        self.domain = username.rpartition("@")[2] or None
+        self.eightbit = capabilities is not None and capabilities.eightbitmime
+        self.max_size = capabilities.max_size if capabilities is not None else None
+        self.mail_options = ("BODY=8BITMIME",) if self.eightbit else ()
+
         # Déterminer le type de contenu (texte simple ou HTML)
-        content_type = "html" if is_html else "plain"
-        msg.attach(MIMEText(body, content_type))
+        self.content_type = "html" if is_html else "plain"
+        self.body_part = self.encode_body(body)
+
+        self.head = (
+            SMTP_POLICY.fold("Content-Type", f'multipart/mixed; boundary="{self.boundary}"')
+            + "MIME-Version: 1.0\r\n"
+            + SMTP_POLICY.fold("From", username)
+        ).encode("ascii")
+        self.subject_header = SMTP_POLICY.fold("Subject", subject).encode("ascii")
+        self.delimiter = f"--{self.boundary}\r\n".encode("ascii")
+        self.close_delimiter = f"--{self.boundary}--\r\n".encode("ascii")
+
+    def encode_body(self, body):
+        """
+        Partie texte/HTML en octets, pour le squelette ou pour un corps personnalisé.
+        Encodage le moins coûteux autorisé : tel quel (7bit, ou 8bit si le
+        serveur accepte 8BITMIME) quand aucune ligne ne dépasse la limite SMTP,
+        sinon le plus court de quoted-printable et base64.
+        """
+        data = body.encode("utf-8")
+        lines = _LINE_BREAK.split(data)
+        if max(map(len, lines)) <= SMTP_MAX_LINE and b"\0" not in data and (self.eightbit or data.isascii()):
+            encoding = "7bit" if data.isascii() else "8bit"
+            payload = b"\r\n".join(lines)
+        else:
+            quoted = binascii.b2a_qp(b"\n".join(lines), istext=True).replace(b"\n", b"\r\n")
+            encoded = base64.encodebytes(data).replace(b"\n", b"\r\n")
+            encoding, payload = ("quoted-printable", quoted) if len(quoted) <= len(encoded) else ("base64", encoded)
+        headers = (
+            f'Content-Type: text/{self.content_type}; charset="utf-8"\r\n'
+            f"Content-Transfer-Encoding: {encoding}\r\n\r\n"
+        ).encode("ascii")
+        return headers + payload
 
-        # Ajouter la pièce jointe
+    def attachment_part(self, attachment_path):
+        """Partie MIME de la pièce jointe, depuis le cache si disponible."""
+        if self.attachment_cache is not None:
+            return self.attachment_cache.get(attachment_path)
         with open(attachment_path, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
-        encoders.encode_base64(part)
-        part.add_header("Content-Disposition", f'attachment; filename="{attachment_path.split("/")[-1]}"')
-        msg.attach(part)
+            return encode_attachment_part(attachment.read(), os.path.basename(attachment_path))
+
+    def build_bytes(self, recipient, attachment_path, body=None):
+        """
+        Message complet pour un destinataire, prêt pour SMTP.sendmail.
+        `body` remplace le corps du squelette (modèle personnalisé, voir app.templating).
+        """
+        with self.tracer.span("attachment"):
+            attachment_part = self.attachment_part(attachment_path)
+        with self.tracer.span("build"):
+            body_part = self.body_part if body is None else self.encode_body(body)
+            msg_bytes = b"".join((
+                self.head,
+                SMTP_POLICY.fold("To", recipient).encode("ascii"),
+                self.subject_header,
+                f"Date: {formatdate(localtime=True)}\r\n".encode("ascii"),
+                SMTP_POLICY.fold("Message-ID", make_msgid(domain=self.domain)).encode("ascii"),
+                b"\r\n",
+                self.delimiter,
+                body_part,
+                b"\r\n",
+                self.delimiter,
+                attachment_part,
+                b"\r\n",
+                self.close_delimiter,
+            ))
+        if self.max_size is not None and len(msg_bytes) > self.max_size:
+            raise MessageTooLargeError(
+                f"Message de {format_size(len(msg_bytes))}, au-delà de la limite du serveur "
+                f"({format_size(self.max_size)}) : non transmis"
+            )
+        return msg_bytes
+
+# Dossier par défaut des sorties de simulation (un fichier par campagne)
+DRY_RUN_DIR = "simulations"
+# Caractères conservés dans le nom des fichiers .eml d'une simulation
+_UNSAFE_FILE_CHARS = re.compile(r"[^A-Za-z0-9@._-]+")
+# Nom des fichiers .eml écrits par une simulation : numéro d'ordre puis destinataire
+_DRY_RUN_EML = re.compile(r"\d{6}_[A-Za-z0-9@._-]*\.eml")
+
+class DryRunOutput:
+    """
+    Sortie d'une simulation d'envoi : les messages, construits exactement comme
+    pour un envoi réel, sont écrits dans un fichier mbox (chemin en .mbox) ou
+    dans un dossier de fichiers .eml au lieu d'être transmis au serveur.
+    Garde la taille et le temps de construction de chaque message.
+    Partagée par tous les workers : les .eml sont écrits en parallèle,
+    l'ajout au mbox est sérialisé.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_mbox = path.lower().endswith(".mbox")
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        # (destinataire, taille en octets, temps de construction en ms), dans l'ordre d'écriture
+        self.records = []
+        self.total_bytes = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        # Une simulation remplace la sortie de la précédente, et rien d'autre
+        if self.is_mbox:
+            if os.path.exists(path):
+                with open(path, "rb") as existing:
+                    head = existing.read(5)
+                if head and head != b"From ":
+                    raise FileExistsError(f"{path} existe déjà et n'est pas un fichier mbox")
+                os.remove(path)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.mbox = mailbox.mbox(path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for entry in os.scandir(path):
+                if _DRY_RUN_EML.fullmatch(entry.name):
+                    os.remove(entry.path)
+            self.mbox = None
+        print(f"Log (email_sender): Simulation d'envoi vers {path}")
+
+    def write(self, recipient, msg_bytes, build_time):
+        if self.mbox is None:
+            name = f"{next(self.sequence):06d}_{_UNSAFE_FILE_CHARS.sub('_', recipient)}.eml"
+            with open(os.path.join(self.path, name), "wb") as eml_file:
+                eml_file.write(msg_bytes)
+        with self.lock:
+            if self.mbox is not None:
+                # Fins de ligne locales dans un mbox ; les lignes "From " sont échappées par mailbox
+                self.mbox.add(msg_bytes.replace(b"\r\n", b"\n"))
+            self.records.append((recipient, len(msg_bytes), build_time * 1000))
+            self.total_bytes += len(msg_bytes)
+
+    def close(self):
+        with self.lock:
+            if self.mbox is not None:
+                self.mbox.close()
+                self.mbox = None
+            if self.finished is None:
+                self.finished = time.perf_counter()
+
+    def summary(self):
+        """Totaux de la simulation : nombre, taille et temps de construction des messages."""
+        with self.lock:
+            sizes = [size for _, size, _ in self.records]
+            build_ms = [ms for _, _, ms in self.records]
+            elapsed = (self.finished or time.perf_counter()) - self.started
+        count = len(sizes)
+        return {
+            "messages": count,
+            "total_bytes": self.total_bytes,
+            "avg_bytes": self.total_bytes / count if count else 0,
+            "max_bytes": max(sizes, default=0),
+            "avg_build_ms": sum(build_ms) / count if count else 0,
+            "max_build_ms": max(build_ms, default=0),
+            "elapsed_s": elapsed,
+            "messages_per_s": count / elapsed if elapsed > 0 else 0,
+        }
+
+    def describe(self):
+        summary = self.summary()
+        return (
+            f"{summary['messages']} messages, {summary['total_bytes'] / 1024 / 1024:.1f} Mo "
+            f"(moyenne {summary['avg_bytes'] / 1024:.1f} Ko, max {summary['max_bytes'] / 1024:.1f} Ko), "
+            f"construction {summary['avg_build_ms']:.2f} ms en moyenne (max {summary['max_build_ms']:.2f} ms), "
+            f"{summary['messages_per_s']:.0f} messages/s"
+        )
+
+def send_email_message(smtp_server, smtp_port, username, password, recipient, subject, body, attachment_path, is_html=False, session=None, tracer=None):
+    """
+    Envoie un email avec pièce jointe.
+    Si une SMTPSession est fournie, sa connexion est réutilisée ; sinon une
+    connexion temporaire est ouverte puis fermée pour ce seul message.
+    """
+    try:
+        print(f"Log (email_sender): Préparation de l'email pour {recipient}")
+        builder = CampaignMessageBuilder(username, subject, body, is_html=is_html, tracer=tracer)
+        msg_bytes = builder.build_bytes(recipient, attachment_path)
 
         # Envoi de l'email
-        server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
-        server.starttls()
-        server.login(username, password)
-        server.send_message(msg)
-        server.quit()
+        if session is not None:
+            session.sendmail(username, [recipient], msg_bytes)
+        else:
+            with SMTPSession(smtp_server, smtp_port, username, password, tracer=tracer) as temporary_session:
+                temporary_session.sendmail(username, [recipient], msg_bytes)
         print(f"Log (email_sender): Email envoyé à {recipient}")
         return True, "Email envoyé"
     except Exception as e:
         print(f"Log (email_sender): Erreur lors de l'envoi à {recipient}: {e}")
-        return False, str(e)
\ No newline at end of file
+        return False, str(e)
@@ -0,0 +1,151 @@
+import csv
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+# Étapes mesurées sur le chemin d'envoi
+PHASES = ("connect", "starttls", "login", "attachment", "build", "data", "message")
+
+class _Span:
+    __slots__ = ("tracer", "phase", "fields", "started")
+
+    def __init__(self, tracer, phase, fields):
+        self.tracer = tracer
+        self.phase = phase
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.phase, time.perf_counter() - self.started, error=exc_type is not None, **self.fields)
+        return False
+
+class Tracer:
+    """
+    Mesure la durée de chaque étape du chemin d'envoi et transmet un
+    enregistrement par mesure à un ou plusieurs sinks (journalisation,
+    fichier de trace, agrégateur en mémoire).
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def span(self, phase, **fields):
+        return _Span(self, phase, fields)
+
+    def record(self, phase, duration, **fields):
+        record = {"timestamp": time.time(), "phase": phase, "duration_ms": duration * 1000, **fields}
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def summary(self):
+        """Récapitulatif par étape du premier sink agrégateur, s'il y en a un."""
+        for sink in self.sinks:
+            if hasattr(sink, "summary"):
+                return sink.summary()
+        return []
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+
+class NullTracer:
+    """Tracer désactivé : span() retourne un contexte vide partagé, coût quasi nul."""
+    _span = nullcontext()
+
+    def span(self, phase, **fields):
+        return self._span
+
+    def record(self, phase, duration, **fields):
+        pass
+
+    def summary(self):
+        return []
+
+    def close(self):
+        pass
+
+NULL_TRACER = NullTracer()
+
+class AggregatorSink:
+    """Agrège en mémoire nombre, durée totale et maximale par étape."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def emit(self, record):
+        duration = record["duration_ms"]
+        with self.lock:
+            stats = self.stats.setdefault(record["phase"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0})
+            stats["count"] += 1
+            stats["total_ms"] += duration
+            stats["max_ms"] = max(stats["max_ms"], duration)
+            stats["errors"] += bool(record.get("error"))
+
+    def summary(self):
+        with self.lock:
+            rows = [
+                {
+                    "phase": phase,
+                    "count": stats["count"],
+                    "total_ms": round(stats["total_ms"], 2),
+                    "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+                    "max_ms": round(stats["max_ms"], 2),
+                    "errors": stats["errors"],
+                }
+                for phase, stats in self.stats.items()
+            ]
+        order = {phase: i for i, phase in enumerate(PHASES)}
+        return sorted(rows, key=lambda row: order.get(row["phase"], len(order)))
+
+class JsonlTraceSink:
+    """Écrit une ligne JSON par mesure dans un fichier de trace."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def emit(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class CsvTraceSink:
+    """Écrit une ligne CSV par mesure (colonnes fixes, champs supplémentaires ignorés)."""
+    fieldnames = ["timestamp", "phase", "duration_ms", "email", "error"]
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction="ignore")
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def emit(self, record):
+        with self.lock:
+            self.writer.writerow(record)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class LoggingSink:
+    """Transmet chaque mesure au module logging, avec l'enregistrement complet en extra."""
+
+    def __init__(self, logger_name="envoi_places.trace", level=logging.DEBUG):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+
+    def emit(self, record):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s %.2f ms", record["phase"], record["duration_ms"], extra={"trace": record})
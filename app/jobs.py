@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import uuid
+from app.dispatcher import dispatch_emails
+from app.journal import SendJournal
+from app.metrics import SendMetrics
+from app.statuses import STATUS_SENT, STATUS_SIMULATED, STATUS_FAILED, STATUS_INTERRUPTED
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+
+# Durée de conservation d'une campagne terminée dans le registre (s), le temps d'afficher son rapport
+FINISHED_JOB_TTL = 3600
+
+# Registre des campagnes en cours, partagé par toutes les sessions Streamlit du processus
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+class SendJob:
+    """
+    Campagne d'envoi exécutée dans un thread d'arrière-plan, indépendamment
+    des reruns Streamlit. L'interface interroge les compteurs via snapshot()
+    et peut interrompre l'envoi avec cancel().
+    Les statuts de chaque ligne sont tenus dans une StatusTable (app.statuses),
+    mise à jour en place au fil des résultats ; metrics (SendMetrics) donne
+    le débit, le temps restant et les files d'attente pendant l'envoi.
+    Une simulation (dry_run dans dispatch_kwargs) n'écrit rien dans le journal d'envoi.
+    """
+
+    def __init__(self, campaign_id, jobs, statuses, dispatch_kwargs):
+        self.id = uuid.uuid4().hex[:12]
+        self.campaign_id = campaign_id
+        self.jobs = jobs
+        self.statuses = statuses
+        self.dispatch_kwargs = dispatch_kwargs
+        self.total = len(jobs)
+        self.attachment_dirs = {os.path.dirname(job["attachment_path"]) for job in jobs}
+        self.metrics = SendMetrics(self.total)
+        self.sent = 0
+        self.failed = 0
+        self.last_email = None
+        self.error = None
+        self.state = JOB_RUNNING
+        self.started_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"send-job-{self.id}", daemon=True)
+
+    @property
+    def finished(self):
+        return self.state != JOB_RUNNING
+
+    @property
+    def dry_run(self):
+        """DryRunOutput de la campagne s'il s'agit d'une simulation, sinon None."""
+        return self.dispatch_kwargs.get("dry_run")
+
+    def cancel(self):
+        print(f"Log (jobs): Annulation demandée pour la campagne {self.id}")
+        self.cancel_event.set()
+
+    def snapshot(self):
+        """Compteurs courants, copiés sous verrou (appel peu coûteux)."""
+        with self.lock:
+            return {
+                "id": self.id,
+                "state": self.state,
+                "total": self.total,
+                "sent": self.sent,
+                "failed": self.failed,
+                "done": self.sent + self.failed,
+                "last_email": self.last_email,
+                "error": self.error,
+            }
+
+    def timings(self):
+        """Temps par étape mesurés pendant la campagne (vide si la mesure est désactivée)."""
+        tracer = self.dispatch_kwargs.get("tracer")
+        return tracer.summary() if tracer is not None else []
+
+    def _run(self):
+        print(f"Log (jobs): Démarrage de la campagne {self.id} ({self.total} emails)")
+        try:
+            results = dispatch_emails(self.jobs, cancel_event=self.cancel_event, metrics=self.metrics, **self.dispatch_kwargs)
+            success_code = STATUS_SIMULATED if self.dry_run is not None else STATUS_SENT
+            with SendJournal() as journal:
+                for job, success, msg in results:
+                    # Une simulation n'a rien envoyé : une reprise ne doit pas sauter ces emails
+                    if self.dry_run is None:
+                        journal.record(self.campaign_id, job["email"], job["file"], success, msg, sender=job.get("sender"))
+                    if success:
+                        self.statuses.set(job["index"], success_code, sender=job.get("sender"))
+                    else:
+                        self.statuses.set(job["index"], STATUS_FAILED, detail=msg, sender=job.get("sender"))
+                    with self.lock:
+                        if success:
+                            self.sent += 1
+                        else:
+                            self.failed += 1
+                        self.last_email = job["email"]
+            state = JOB_CANCELLED if self.cancel_event.is_set() else JOB_DONE
+        except Exception as e:
+            print(f"Log (jobs): Erreur dans la campagne {self.id}: {e}")
+            self.error = str(e)
+            state = JOB_FAILED
+        if self.dispatch_kwargs.get("tracer") is not None:
+            self.dispatch_kwargs["tracer"].close()
+        if self.dry_run is not None:
+            self.dry_run.close()
+        # Les envois jamais démarrés (annulation ou erreur) restent visibles dans le rapport
+        self.statuses.fill_pending(STATUS_INTERRUPTED)
+        with self.lock:
+            self.state = state
+            self.finished_at = time.time()
+            # Les messages préparés ne servent plus : seuls les statuts restent en mémoire.
+            # Les identifiants SMTP (mot de passe, comptes) ne sont pas gardés dans le registre,
+            # seuls la mesure et la simulation servent encore au récapitulatif
+            self.jobs = None
+            self.dispatch_kwargs = {key: self.dispatch_kwargs.get(key) for key in ("tracer", "dry_run")}
+        print(f"Log (jobs): Campagne {self.id} terminée ({state})")
+
+def submit_send_job(campaign_id, jobs, statuses, **dispatch_kwargs):
+    """
+    Lance une campagne en arrière-plan et retourne son SendJob.
+    Si une campagne identique est déjà en cours, elle est retournée telle quelle.
+    """
+    with _jobs_lock:
+        _prune_finished_jobs()
+        active = find_active_job(campaign_id)
+        if active is not None:
+            return active
+        job = SendJob(campaign_id, jobs, statuses, dispatch_kwargs)
+        _jobs[job.id] = job
+    job.thread.start()
+    return job
+
+def _prune_finished_jobs():
+    """Retire du registre les campagnes terminées depuis plus de FINISHED_JOB_TTL (appelé sous _jobs_lock)."""
+    limit = time.time() - FINISHED_JOB_TTL
+    for job_id, job in list(_jobs.items()):
+        if job.finished and job.finished_at is not None and job.finished_at < limit:
+            del _jobs[job_id]
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+def find_active_job(campaign_id):
+    """Retourne la campagne en cours pour campaign_id, par exemple après fermeture de l'onglet."""
+    for job in list(_jobs.values()):
+        if job.campaign_id == campaign_id and not job.finished:
+            return job
+    return None
+
+def active_attachment_dirs():
+    """Dossiers des pièces jointes des campagnes en cours, à protéger du nettoyage du magasin."""
+    return {folder for job in list(_jobs.values()) if not job.finished for folder in job.attachment_dirs}
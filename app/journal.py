@@ -0,0 +1,96 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+JOURNAL_PATH = "send_journal.sqlite3"
+
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+def campaign_id_for(mapping_df, subject, mapping_csv=None):
+    """
+    Identifiant stable d'une campagne : empreinte de la distribution et de l'objet.
+    Relancer la même distribution avec le même objet retrouve donc le même journal.
+    `mapping_csv` (CSV de la distribution déjà encodé, voir save_distribution_csv)
+    évite de reconvertir la distribution à chaque appel.
+    """
+    digest = hashlib.sha256(subject.encode("utf-8"))
+    digest.update(mapping_csv if mapping_csv is not None else mapping_df.to_csv(index=False).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+class SendJournal:
+    """
+    Journal d'envoi persistant (SQLite), en ajout seul.
+    Chaque envoi terminé y est écrit immédiatement, avec la clé
+    (campagne, destinataire, pièce jointe), afin qu'une campagne interrompue
+    puisse reprendre sans renvoyer les emails déjà confirmés.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS send_journal (
+                campaign_id TEXT NOT NULL,
+                email TEXT NOT NULL,
+                file TEXT NOT NULL,
+                status TEXT NOT NULL,
+                message TEXT,
+                recorded_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_send_journal_key ON send_journal (campaign_id, email, file)"
+        )
+        # Journaux créés avant l'envoi multi-comptes : ajout de la colonne du compte expéditeur
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(send_journal)")}
+        if "sender" not in columns:
+            self.conn.execute("ALTER TABLE send_journal ADD COLUMN sender TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_send_journal_sender ON send_journal (sender, recorded_at)"
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def record(self, campaign_id, email, file, success, message="", sender=None):
+        status = STATUS_SENT if success else STATUS_FAILED
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO send_journal (campaign_id, email, file, status, message, recorded_at, sender) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (campaign_id, email, file, status, message, time.time(), sender),
+            )
+            # Une transaction par envoi : l'entrée est sur disque avant de passer au suivant
+            self.conn.commit()
+
+    def confirmed(self, campaign_id):
+        """Retourne l'ensemble des couples (email, fichier) déjà envoyés avec succès."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT email, file FROM send_journal WHERE campaign_id = ? AND status = ?",
+                (campaign_id, STATUS_SENT),
+            ).fetchall()
+        return set(rows)
+
+    def sent_since(self, sender, since):
+        """Nombre d'emails envoyés avec succès par le compte sender depuis l'instant since (toutes campagnes)."""
+        with self.lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM send_journal WHERE sender = ? AND status = ? AND recorded_at >= ?",
+                (sender, STATUS_SENT, since),
+            ).fetchone()
+        return count
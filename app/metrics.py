@@ -0,0 +1,76 @@
+import smtplib
+import threading
+import time
+from collections import Counter, deque
+from app.email_sender import smtp_error_code
+
+# Fenêtre glissante du débit affiché (s)
+THROUGHPUT_WINDOW_SECONDS = 30.0
+
+def error_label(error):
+    """Code SMTP de l'erreur, ou sa catégorie si le serveur n'a pas répondu."""
+    code = smtp_error_code(error)
+    if code is not None:
+        return str(code)
+    if isinstance(error, (smtplib.SMTPServerDisconnected, OSError)):
+        return "connexion"
+    return "autre"
+
+class SendMetrics:
+    """
+    Indicateurs d'une campagne en cours, alimentés par la boucle du
+    dispatcher : débit sur une fenêtre glissante, envois en cours, relances
+    en attente et erreurs par code SMTP. Chaque mise à jour est en O(1) ;
+    snapshot() est appelé par l'interface à fréquence bornée.
+    """
+
+    def __init__(self, total, window=THROUGHPUT_WINDOW_SECONDS):
+        self.total = total
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.completions = deque()
+        self.done = 0
+        self.attempts = 0
+        self.in_flight = 0
+        self.retry_backlog = 0
+        self.errors_by_code = Counter()
+
+    def record_attempt(self, error=None):
+        """Fin d'une tentative d'envoi (réussie si error est None)."""
+        with self.lock:
+            self.attempts += 1
+            if error is not None:
+                self.errors_by_code[error_label(error)] += 1
+
+    def record_done(self):
+        """Un envoi a son résultat définitif (succès ou échec)."""
+        now = time.monotonic()
+        with self.lock:
+            self.done += 1
+            self.completions.append(now)
+
+    def update_queues(self, in_flight, retry_backlog):
+        self.in_flight = in_flight
+        self.retry_backlog = retry_backlog
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.completions and now - self.completions[0] > self.window:
+                self.completions.popleft()
+            # Au démarrage, le débit est mesuré depuis le début plutôt que sur toute la fenêtre
+            span = min(self.window, now - self.started)
+            rate = len(self.completions) / span if span > 0 else 0.0
+            remaining = max(self.total - self.done, 0)
+            failed_attempts = sum(self.errors_by_code.values())
+            return {
+                "done": self.done,
+                "total": self.total,
+                "rate": rate,
+                "eta_seconds": remaining / rate if rate > 0 else None,
+                "in_flight": self.in_flight,
+                "retry_backlog": self.retry_backlog,
+                "errors_by_code": dict(self.errors_by_code.most_common()),
+                "error_rate": failed_attempts / self.attempts if self.attempts else 0.0,
+            }
@@ -0,0 +1,94 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pypdf import PdfReader, PdfWriter
+from app.attachment_cache import attachment_cache
+from app.attachment_store import attachment_store, write_blob
+from app.email_sender import encode_attachment_part
+
+# En dessous de ce nombre de pages, le découpage se fait dans le processus courant
+SPLIT_POOL_THRESHOLD = 32
+# Pages traitées par tâche du pool : chaque tâche relit l'index du PDF une seule fois
+SPLIT_CHUNK_PAGES = 64
+
+def ticket_file_name(stem, page_number, page_count):
+    """
+    Nom du fichier de la page page_number (à partir de 1). Le numéro est
+    complété par des zéros pour que le tri par nom suive l'ordre des pages.
+    """
+    width = max(3, len(str(page_count)))
+    return f"{stem}_{page_number:0{width}d}.pdf"
+
+def _split_pages(bundle_path, store_root, stem, page_count, start, stop):
+    """
+    Stocke chacune des pages [start, stop[ du PDF comme un fichier séparé dans le
+    magasin de pièces jointes et retourne, pour chacune, (nom de fichier,
+    empreinte sha256, partie MIME encodée).
+    Fonction de module pour pouvoir être exécutée dans un pool de processus.
+    """
+    reader = PdfReader(bundle_path)
+    results = []
+    for page_index in range(start, stop):
+        writer = PdfWriter()
+        writer.add_page(reader.pages[page_index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        data = buffer.getbuffer()
+        digest = hashlib.sha256(data).hexdigest()
+        write_blob(store_root, digest, data)
+        file_name = ticket_file_name(stem, page_index + 1, page_count)
+        results.append((file_name, digest, encode_attachment_part(data, file_name)))
+    return results
+
+def split_ticket_bundle(bundle_path, stem=None, store=attachment_store, max_workers=None):
+    """
+    Découpe un PDF contenant une place par page en un fichier par place, publié
+    comme jeu de places dans le magasin de pièces jointes.
+    Retourne (dossier du jeu, chemins dans l'ordre des pages).
+    Les pages sont découpées par lots dans un pool de processus pour les gros
+    PDF ; chaque place est directement ajoutée au cache des pièces jointes.
+    """
+    if stem is None:
+        stem = os.path.splitext(os.path.basename(bundle_path))[0]
+    page_count = len(PdfReader(bundle_path).pages)
+    print(f"Log (pdf_split): Découpage de {bundle_path} ({page_count} pages)")
+
+    chunks = [
+        (bundle_path, store.root, stem, page_count, start, min(start + SPLIT_CHUNK_PAGES, page_count))
+        for start in range(0, page_count, SPLIT_CHUNK_PAGES)
+    ]
+    results = None
+    if page_count >= SPLIT_POOL_THRESHOLD:
+        context = multiprocessing.get_context("forkserver")
+        workers = max_workers or min(os.cpu_count() or 1, len(chunks))
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                results = list(pool.map(_split_pages, *zip(*chunks)))
+        except BrokenProcessPool as e:
+            print(f"Log (pdf_split): Pool de processus indisponible ({e}), découpage local")
+    if results is None:
+        results = [_split_pages(*chunk) for chunk in chunks]
+
+    pages = [page for chunk_results in results for page in chunk_results]
+    folder, paths = store.publish([(file_name, digest) for file_name, digest, _ in pages])
+    for path, (_, digest, part) in zip(paths, pages):
+        attachment_cache.put(path, digest, part)
+    print(f"Log (pdf_split): {len(paths)} places générées dans {folder}")
+    return folder, paths
+
+def split_uploaded_bundle(bundle_file, store=attachment_store, max_workers=None):
+    """
+    Découpe un PDF uploadé (une place par page) dans le magasin de pièces jointes.
+    Le PDF est d'abord écrit dans un fichier temporaire, lu ensuite par les processus.
+    """
+    stem = os.path.splitext(os.path.basename(bundle_file.name))[0]
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(bundle_file.getbuffer())
+    try:
+        return split_ticket_bundle(tmp.name, stem=stem, store=store, max_workers=max_workers)
+    finally:
+        os.remove(tmp.name)
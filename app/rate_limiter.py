@@ -0,0 +1,63 @@
+import threading
+import time
+
+class AdaptiveRateLimiter:
+    """
+    Limiteur de débit à seau de jetons (token bucket), partagé entre les workers.
+    Le budget est exprimé en messages par minute. Sur une réponse temporaire du
+    serveur (4xx : 421, 451...) le débit est divisé par deux, puis il remonte
+    progressivement vers le budget configuré à chaque envoi réussi.
+    """
+
+    def __init__(self, rate_per_minute, burst=1, min_rate_per_minute=1, recovery=0.1):
+        self.max_rate = rate_per_minute / 60.0
+        self.min_rate = min(min_rate_per_minute, rate_per_minute) / 60.0
+        self.rate = self.max_rate
+        self.capacity = max(1, burst)
+        self.recovery = recovery
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def rate_per_minute(self):
+        return self.rate * 60.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, cancel_event=None):
+        """
+        Bloque jusqu'à ce qu'un jeton soit disponible et retourne True.
+        Retourne False sans consommer de jeton dès que `cancel_event` est levé.
+        """
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel_event is not None:
+                cancel_event.wait(wait)
+            else:
+                time.sleep(wait)
+
+    def penalize(self):
+        """Ralentit après une réponse 4xx du serveur."""
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+        print(f"Log (rate_limiter): Débit réduit à {self.rate_per_minute:.1f} emails/minute")
+
+    def reward(self):
+        """Remonte progressivement le débit après un envoi réussi."""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
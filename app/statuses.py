@@ -0,0 +1,158 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# Codes de statut d'une ligne de distribution (un octet par ligne)
+STATUS_PENDING = 0
+STATUS_SENT = 1
+STATUS_PREVIOUSLY_SENT = 2
+STATUS_SIMULATED = 3
+STATUS_FAILED = 4
+STATUS_UNASSIGNED = 5
+STATUS_REJECTED = 6
+STATUS_INTERRUPTED = 7
+
+# Libellé de chaque code ; le détail éventuel (erreur, motif) est ajouté après ": "
+STATUS_LABELS = (
+    "En attente",
+    "Succès",
+    "Succès (envoi précédent)",
+    "Succès (simulation)",
+    "Erreur",
+    "Aucun envoi (place non attribuée)",
+    "Rejeté",
+    "Non envoyé (campagne interrompue)",
+)
+
+# Compteurs du récapitulatif : catégorie -> codes comptés
+STATUS_CATEGORIES = {
+    "success": (STATUS_SENT, STATUS_PREVIOUSLY_SENT, STATUS_SIMULATED),
+    "error": (STATUS_FAILED,),
+    "skipped": (STATUS_UNASSIGNED,),
+    "rejected": (STATUS_REJECTED,),
+}
+
+class StatusTable:
+    """
+    Statuts d'envoi d'une distribution, rangés en colonnes : un code de statut
+    et un indice de compte d'envoi par ligne, noms de fichiers partagés
+    (catégories), texte (erreur, motif de rejet) conservé à part pour les
+    seules lignes qui en ont un. Les mises à jour se font en place par indice
+    de ligne et les compteurs sont tenus à jour au fil de l'eau : le
+    récapitulatif ne reparcourt jamais les lignes.
+    """
+
+    def __init__(self, emails, files):
+        self.emails = np.asarray(emails, dtype=object)
+        self.files = pd.Categorical(files)
+        self.codes = np.full(len(self.emails), STATUS_PENDING, dtype=np.int8)
+        self.senders = np.full(len(self.emails), -1, dtype=np.int16)
+        self.sender_names = []
+        self.sender_ids = {}
+        self.details = {}
+        self.counts = np.zeros(len(STATUS_LABELS), dtype=np.int64)
+        self.counts[STATUS_PENDING] = len(self.emails)
+        self.sent_by_sender = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        # (version, DataFrame) du dernier tableau construit, (version, octets) du dernier CSV
+        self._frame = None
+        self._csv = None
+
+    @classmethod
+    def from_mapping(cls, mapping_df, already_sent=()):
+        """
+        Table initiale d'une distribution : lignes rejetées (motif), places non
+        attribuées et envois déjà confirmés (`already_sent`, couples
+        (email, fichier)) reçoivent leur statut ; les autres restent en attente.
+        """
+        table = cls(mapping_df["email"], mapping_df["file"])
+        if "motif" in mapping_df:
+            motifs = mapping_df["motif"].astype(object).fillna("").to_numpy()
+            rejected = np.flatnonzero(motifs != "")
+            table.set_many(rejected, STATUS_REJECTED, details=motifs[rejected])
+        # Contact sans place (fichier "Non attribué") ou place sans contact : rien à envoyer
+        files = np.asarray(table.files, dtype=object)
+        unassigned = ((table.emails == "Non attribué") | (files == "Non attribué")) & (table.codes == STATUS_PENDING)
+        table.set_many(np.flatnonzero(unassigned), STATUS_UNASSIGNED)
+        if already_sent:
+            previous = [index for index in table.pending_rows() if (table.emails[index], files[index]) in already_sent]
+            table.set_many(previous, STATUS_PREVIOUSLY_SENT)
+        return table
+
+    def __len__(self):
+        return len(self.codes)
+
+    def pending_rows(self):
+        return np.flatnonzero(self.codes == STATUS_PENDING)
+
+    def set_many(self, indices, code, details=None):
+        """Même statut pour plusieurs lignes sans compte d'envoi (statuts initiaux)."""
+        indices = np.asarray(indices, dtype=np.intp)
+        with self.lock:
+            self.counts -= np.bincount(self.codes[indices], minlength=len(STATUS_LABELS))
+            self.counts[code] += len(indices)
+            self.codes[indices] = code
+            if details is not None:
+                self.details.update(zip(indices.tolist(), details))
+            self.version += 1
+
+    def set(self, index, code, detail=None, sender=None):
+        """Statut d'une ligne, mis à jour en place avec les compteurs."""
+        with self.lock:
+            previous = self.codes[index]
+            if previous == STATUS_SENT and self.senders[index] >= 0:
+                self.sent_by_sender[self.sender_names[self.senders[index]]] -= 1
+            self.counts[previous] -= 1
+            self.counts[code] += 1
+            self.codes[index] = code
+            if sender:
+                if sender not in self.sender_ids:
+                    self.sender_ids[sender] = len(self.sender_names)
+                    self.sender_names.append(sender)
+                self.senders[index] = self.sender_ids[sender]
+                if code == STATUS_SENT:
+                    self.sent_by_sender[sender] = self.sent_by_sender.get(sender, 0) + 1
+            else:
+                self.senders[index] = -1
+            if detail:
+                self.details[index] = detail
+            else:
+                self.details.pop(index, None)
+            self.version += 1
+
+    def fill_pending(self, code):
+        """Donne le statut `code` à toutes les lignes encore en attente."""
+        self.set_many(self.pending_rows(), code)
+
+    def category_counts(self):
+        """Compteurs du récapitulatif (succès, erreurs, places restantes, rejets), sans parcourir les lignes."""
+        with self.lock:
+            return {category: int(self.counts[list(codes)].sum()) for category, codes in STATUS_CATEGORIES.items()}
+
+    def to_frame(self):
+        """
+        Tableau email / fichier / statut / compte, au format du rapport d'envoi.
+        Reconstruit seulement si des statuts ont changé depuis le dernier appel.
+        """
+        with self.lock:
+            if self._frame is not None and self._frame[0] == self.version:
+                return self._frame[1]
+            statuses = np.array(STATUS_LABELS, dtype=object)[self.codes]
+            for index, detail in self.details.items():
+                statuses[index] = f"{statuses[index]}: {detail}"
+            # Indice -1 (aucun compte) : dernier élément, vide
+            senders = np.array(self.sender_names + [""], dtype=object)[self.senders]
+            frame = pd.DataFrame({"email": self.emails, "fichier": self.files, "statut": statuses, "compte": senders})
+            self._frame = (self.version, frame)
+            return frame
+
+    def to_csv(self):
+        """Rapport d'envoi en CSV (octets UTF-8), mis en cache comme to_frame()."""
+        version = self.version
+        if self._csv is not None and self._csv[0] == version:
+            return self._csv[1]
+        frame = self.to_frame()
+        csv_bytes = frame.to_csv(index=False).encode("utf-8")
+        self._csv = (version, csv_bytes)
+        return csv_bytes
@@ -0,0 +1,104 @@
+import re
+from functools import lru_cache
+import pandas as pd
+
+# Champ personnalisé : {{nom de colonne}}, espaces autour du nom ignorés
+PLACEHOLDER_PATTERN = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+
+# Blocs dont les espaces sont significatifs et conservés tels quels
+_PRESERVED_BLOCK = re.compile(r"<(pre|textarea)\b.*?</\1\s*>", re.S | re.I)
+# Commentaires HTML, sauf commentaires conditionnels (<!--[if mso]>...)
+_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.S)
+# Espaces HTML uniquement : les espaces insécables (\xa0) sont du contenu
+_WHITESPACE = re.compile(r"[ \t\r\n\f]+")
+
+_HTML_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"), ("'", "&#x27;"))
+
+def _collapse_run(match):
+    # Un retour à la ligne est gardé : les lignes du corps restent sous la limite SMTP de 998 octets,
+    # ce qui permet l'encodage 7bit/8bit au lieu de quoted-printable
+    run = match.group(0)
+    return "\n" if "\n" in run or "\r" in run else " "
+
+def _collapse(markup):
+    return _WHITESPACE.sub(_collapse_run, _COMMENT.sub("", markup))
+
+def minify_html(markup):
+    """
+    Allège le HTML collé depuis Gmail : suppression des commentaires et
+    réduction de chaque suite d'espaces à un seul espace, ou à un seul retour
+    à la ligne si elle en contient un, ce qui ne change pas le rendu (hors
+    <pre> et <textarea>, conservés).
+    """
+    parts = []
+    position = 0
+    for block in _PRESERVED_BLOCK.finditer(markup):
+        parts.append(_collapse(markup[position:block.start()]))
+        parts.append(block.group(0))
+        position = block.end()
+    parts.append(_collapse(markup[position:]))
+    return "".join(parts).strip()
+
+def _format_values(values, escape):
+    """Valeurs d'une colonne en texte : manquantes vides, entiers sans ".0", échappées pour le HTML."""
+    if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+        values = values.astype("Int64")
+    text = values.astype("string").fillna("")
+    if escape:
+        for char, entity in _HTML_ESCAPES:
+            text = text.str.replace(char, entity, regex=False)
+    return text.astype(object)
+
+class CompiledTemplate:
+    """
+    Modèle d'email analysé une seule fois : le texte (minifié pour le HTML) est
+    découpé en parties fixes et en champs {{colonne}}. Rendre un destinataire
+    revient à concaténer ces parties avec ses valeurs ; render_many fait de
+    même pour tout un tableau de valeurs, colonne par colonne.
+    """
+
+    def __init__(self, source, is_html=True):
+        self.is_html = is_html
+        self.source_size = len(source.encode("utf-8"))
+        self.text = minify_html(source) if is_html else source
+        pieces = PLACEHOLDER_PATTERN.split(self.text)
+        self.literals = pieces[0::2]
+        self.fields = pieces[1::2]
+        # Colonnes utilisées, sans doublon, dans l'ordre d'apparition
+        self.columns = list(dict.fromkeys(self.fields))
+
+    @property
+    def has_fields(self):
+        return bool(self.fields)
+
+    @property
+    def size(self):
+        return len(self.text.encode("utf-8"))
+
+    def render(self, values):
+        """Rendu pour un destinataire ; values associe chaque colonne à sa valeur (absente = vide)."""
+        if not self.fields:
+            return self.text
+        row = pd.DataFrame([{column: values.get(column) for column in self.columns}])
+        return self.render_many(row).iloc[0]
+
+    def render_many(self, values_df):
+        """
+        Rendu de toutes les lignes de values_df (une colonne par champ) en une passe.
+        Retourne une Series de textes alignée sur l'index de values_df.
+        """
+        rendered = pd.Series(self.literals[0], index=values_df.index, dtype=object)
+        if not self.fields:
+            return rendered
+        formatted = {
+            column: _format_values(values_df[column], self.is_html) if column in values_df else ""
+            for column in self.columns
+        }
+        for field, literal in zip(self.fields, self.literals[1:]):
+            rendered = rendered + formatted[field] + literal
+        return rendered
+
+@lru_cache(maxsize=16)
+def compile_template(source, is_html=True):
+    """Compile un modèle d'email ; le résultat est mis en cache (les reruns ne recompilent pas)."""
+    return CompiledTemplate(source, is_html=is_html)
@@ -1,9 +1,347 @@
 import streamlit as st
 import os
-import pandas as pd
 import time
-from app.email_sender import check_smtp_connection, send_email_message
-from app.utils import load_contacts_file, save_uploaded_places, create_distribution_mapping, save_distribution_csv
+from functools import lru_cache
+import pandas as pd
+from app.email_sender import check_smtp_connection, get_smtp_capabilities, CORRECT_EMOJIS_STYLE, DryRunOutput, DRY_RUN_DIR
+from app.accounts import SenderAccount, QUOTA_WINDOW_SECONDS
+from app.allocation import PriorityTierStrategy, GroupStrategy, ShuffleStrategy
+from app.attachment_cache import attachment_cache
+from app.attachment_store import attachment_store
+from app.instrumentation import Tracer, AggregatorSink
+from app.jobs import submit_send_job, get_job, find_active_job, active_attachment_dirs, JOB_DONE, JOB_CANCELLED
+from app.journal import SendJournal, campaign_id_for
+from app.validation import validate_contacts, parse_domain_list
+from app.pdf_split import split_uploaded_bundle
+from app.statuses import StatusTable
+from app.templating import compile_template
+from app.utils import load_contacts_file, read_contacts_header, save_uploaded_places, create_distribution_mapping, save_distribution_csv, lookup_contact_values
+
+@lru_cache(maxsize=8)
+def render_preview(template, preview_values):
+    """Aperçu de l'email, recalculé seulement si le modèle ou les valeurs du contact changent."""
+    return template.render(dict(preview_values))
+
+def format_duration(seconds):
+    """Durée lisible : "1 h 05 min", "3 min 20 s", "45 s"."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600} h {seconds % 3600 // 60:02d} min"
+    if seconds >= 60:
+        return f"{seconds // 60} min {seconds % 60:02d} s"
+    return f"{seconds} s"
+
+# Le suivi est rafraîchi au plus une fois par seconde : les lectures des indicateurs
+# restent négligeables pour les workers d'envoi
+@st.fragment(run_every=1.0)
+def render_send_job(job_id):
+    """
+    Suivi d'une campagne en arrière-plan, rafraîchi chaque seconde
+    sans relancer le reste de la page : progression, débit, temps restant,
+    envois en cours, relances en attente, erreurs par code SMTP et statut
+    de chaque ligne.
+    """
+    job = get_job(job_id)
+    if job is None:
+        st.warning("⚠️ Campagne introuvable.")
+        return
+    state = job.snapshot()
+    if job.finished:
+        # Rerun complet pour afficher le récapitulatif de l'étape 6
+        st.rerun()
+    
+    # Progression sur les seuls emails à envoyer (places non attribuées, rejets et reprises exclus)
+    progress = min(100, int(100 * state["done"] / max(state["total"], 1)))
+    st.progress(progress)
+    st.session_state.progress = progress
+    st.text(f"Traitement: {state['done']}/{state['total']} ({state['sent']} envoyés, {state['failed']} en échec)")
+    
+    telemetry = job.metrics.snapshot()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Débit", f"{telemetry['rate']:.1f} emails/s")
+    col2.metric("Temps restant", format_duration(telemetry["eta_seconds"]) if telemetry["eta_seconds"] is not None else "—")
+    col3.metric("En cours", telemetry["in_flight"])
+    col4.metric("Relances en attente", telemetry["retry_backlog"])
+    if telemetry["errors_by_code"]:
+        errors = ", ".join(f"{code} × {count}" for code, count in telemetry["errors_by_code"].items())
+        st.caption(f"Erreurs par code : {errors} ({telemetry['error_rate']:.0%} des tentatives)")
+    if state["last_email"]:
+        st.markdown(f"**Dernier envoi**: {state['last_email']}")
+    # Statuts en direct : le tableau n'est reconstruit que si un statut a changé
+    st.dataframe(job.statuses.to_frame(), use_container_width=True, hide_index=True)
+    if st.button("⏹️ Annuler l'envoi", help="Arrêter la campagne après les envois en cours"):
+        job.cancel()
+
+def render_send_job_result(job):
+    """Affiche l'issue d'une campagne terminée et publie ses statuts pour l'étape 6."""
+    if st.session_state.get("send_statuses_job_id") != job.id:
+        # Référence vers la table de la campagne (partagée, pas de copie par session)
+        st.session_state.send_statuses = job.statuses
+        st.session_state.send_timings = job.timings()
+        st.session_state.send_statuses_job_id = job.id
+    state = job.snapshot()
+    if state["state"] == JOB_DONE and job.dry_run is not None:
+        st.success(f"✅ Simulation terminée : {job.dry_run.describe()}. Emails écrits dans {job.dry_run.path}")
+        with st.expander("📦 Détail de la simulation", expanded=False):
+            st.dataframe(
+                pd.DataFrame(job.dry_run.records, columns=["Destinataire", "Taille (octets)", "Construction (ms)"]),
+                use_container_width=True, hide_index=True
+            )
+    elif state["state"] == JOB_DONE:
+        st.success("✅ Tous les emails ont été traités!")
+    elif state["state"] == JOB_CANCELLED:
+        st.warning(f"⚠️ Envoi annulé après {state['done']}/{state['total']} emails.")
+    else:
+        st.error(f"❌ Erreur pendant l'envoi: {state['error']}")
+
+@st.fragment
+def render_email_and_send_steps(smtp_server, smtp_port, username, password, sender_specs,
+                                max_workers, throttle, rate_per_minute, max_attempts, measure_timings):
+    """
+    Étapes 4 et 5 (rédaction et envoi), isolées dans un fragment : modifier
+    l'objet ou le corps de l'email ne relance que ces deux étapes, sans
+    redessiner la distribution ni le récapitulatif.
+    """
+    # ------------------------------
+    # Étape 4 : Rédaction de l'email
+    # ------------------------------
+    with st.container():
+        st.markdown("<div class='step-container'>", unsafe_allow_html=True)
+        st.markdown("### ✉️ &nbsp;&nbsp; Étape 4: Rédaction de l'email", unsafe_allow_html=True)
+        
+        subject = st.text_input("Objet de l'email", value="🎟️ Ta place pour PARIS BASKETBALL - XXX")
+        
+        # Section d'aide pour récupérer le code HTML de Gmail, maintenant dans un expander
+        with st.expander("💡 Aide : Comment récupérer le code HTML d'un brouillon Gmail   ↓↓↓"):
+            st.markdown("""
+            <div class="gmail-help">
+                <p><strong>Procédure étape par étape :</strong></p>
+                <ol>
+                    <li>Rédige ton email brouillon dans Gmail avec toute la mise en forme souhaitée</li>
+                    <li>Fais un clic droit avec ta souris sur la zone de rédaction et sélectionne "Inspecter"</li>
+                    <li>Sélectionne la petite flèche tout en haut à gauche de la barre qui s'est ouverte</li>
+                    <li>Survole ton message avec ton curseur et clique une fois que tout le texte est en surbrillance</li>
+                    <li>Copie le code associé (commençant par div...) qui est en surbrillance sur la barre de droite</li>
+                    <li>Colle-le dans la zone de saisie ci-dessous</li>
+                </ol>
+                <p><em>Note : Ne t'inquiète pas des balises div, les destinataires verront uniquement la mise en forme finale.</em></p>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # Format de l'email uniquement en HTML
+        default_html = """
+            <div dir="ltr">Hello !
+            <div>
+            <br>
+            </div>
+            <div>C'est le moment d'accueillir&nbsp;à la maison une équipe qu'il faudra&nbsp;
+                <b>
+                    <span zeum4c1="PR_5_0" data-ddnwab="PR_5_0" aria-invalid="grammar" class="Lm ng">BATTRE</span>&nbsp;
+                </b>à n'importe quel prix !!!&nbsp;
+                <img data-emoji="🔥" class="an1" alt="🔥" aria-label="🔥" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f525/72.png" loading="lazy">
+                </div>
+                <div>
+                    <br>
+                    </div>
+                    <div>
+                        <b>Voici&nbsp;ta&nbsp;place&nbsp;pour le match contre XXX.&nbsp;
+                            <img data-emoji="🎟️" class="an1" alt="🎟️" aria-label="🎟️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f39f_fe0f/72.png" loading="lazy">
+                            </b>
+                        </div>
+                        <div>
+                            <b>
+                                <br>
+                                </b>
+                            </div>
+                            <div>
+                                <img data-emoji="⚠️" class="an1" alt="⚠️" aria-label="⚠️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/26a0_fe0f/72.png" loading="lazy">&nbsp;Si tu ne peux assister à cette rencontre et que tu souhaites redistribuer ta place n'hésite pas à nous le préciser en répondant à ce mail ou à nous envoyer ta place sur WhatsApp.&nbsp;
+                                    <img data-emoji="🙏" class="an1" alt="🙏" aria-label="🙏" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f64f/72.png" loading="lazy">
+                                    </div>
+                                    <div>
+                                        <br>
+                                        </div>
+                                        <div>Il va falloir&nbsp;
+                                            <b>RÉPONDRE PRÉSENT&nbsp;</b>en tribune et donner tout ce que tu as pour pousser nos joueurs à gagner ce match.&nbsp;
+                                            <img data-emoji="🌋" class="an1" alt="🌋" aria-label="🌋" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f30b/72.png" loading="lazy">&nbsp;
+                                                <img data-emoji="🗣️" class="an1" alt="🗣️" aria-label="🗣️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f5e3_fe0f/72.png" loading="lazy">
+                                                    <img data-emoji="🥁" class="an1" alt="🥁" aria-label="🥁" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f941/72.png" loading="lazy">
+                                                    </div>
+                                                    <div>
+                                                        <br>
+                                                        </div>
+                                                        <div>
+                                                            <br>
+                                                            </div>
+                                                            <div>
+                                                                <b>
+                                                                    <font color="#ff0000">
+                                                                        <img data-emoji="⌚" class="an1" alt="⌚" aria-label="⌚" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/231a/72.png" loading="lazy">&nbsp;RDV HH:MM en tribune
+                                                                        </font>
+                                                                    </b>
+                                                                </div>
+                                                                <div>
+                                                                    <p>
+                                                                        <b>DRESSCODE : T-SHIRT&nbsp;PARISII&nbsp;OU NOIR&nbsp;
+                                                                            <img data-emoji="⚫" class="an1" alt="⚫" aria-label="⚫" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/26ab/72.png" loading="lazy">
+                                                                            </b>️
+                                                                        </p>
+                                                                        <p>MERCI ET ON COMPTE SUR TOI !!!&nbsp;
+                                                                            <img data-emoji="🖤" class="an1" alt="🖤" aria-label="🖤" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f5a4/72.png" loading="lazy">
+                                                                                <img data-emoji="❤️" class="an1" alt="❤️" aria-label="❤️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/2764_fe0f/72.png" loading="lazy">
+                                                                                    <img data-emoji="💙" class="an1" alt="💙" aria-label="💙" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f499/72.png" loading="lazy">
+                                                                                    </p>
+                                                                                    <p>Le Bureau du&nbsp;KOP&nbsp;Parisii</p>
+                                                                                </div>
+                                                                            </div>
+        """.strip()
+
+        html_text = st.text_area(
+            "Contenu HTML de l'email", value=default_html, height=300, key="email_html",
+            help="Insère {{colonne}} pour personnaliser l'email avec une colonne du fichier de contacts, par exemple {{prenom}}."
+        )
+        is_html = True
+        # Modèle compilé une fois (et minifié) : le corps est rendu pour chaque destinataire à l'envoi
+        template = compile_template(CORRECT_EMOJIS_STYLE + '\n' + html_text)
+        body = template.text
+        st.caption(f"Taille du contenu : {template.size / 1024:.1f} Ko (collé : {template.source_size / 1024:.1f} Ko)")
+        
+        if template.columns != st.session_state.get("contacts_template_columns", []):
+            # L'étape 2 n'a chargé que les colonnes du modèle précédent : rerun complet pour lire les nouveaux champs
+            st.rerun()
+        
+        preview_values = ()
+        if template.has_fields:
+            available_columns = st.session_state.contacts_columns or []
+            unknown = [c for c in template.columns if c not in available_columns]
+            st.info(f"ℹ️ Champs personnalisés : {', '.join(template.columns)}")
+            if unknown:
+                st.warning(f"⚠️ Colonnes introuvables dans le fichier de contacts (remplacées par du vide) : {', '.join(unknown)}")
+            if st.session_state.contacts_df is not None and len(st.session_state.contacts_df):
+                first_contact = st.session_state.contacts_df.iloc[0]
+                preview_values = tuple((column, first_contact.get(column)) for column in template.columns)
+            
+        # Aperçu HTML (premier contact pour un email personnalisé)
+        with st.expander("Aperçu de l'email", expanded=True):
+            st.markdown(render_preview(template, preview_values), unsafe_allow_html=True)
+        st.markdown("</div>", unsafe_allow_html=True)
+
+    # ------------------------------
+    # Étape 5 : Envoi des emails
+    # ------------------------------
+    with st.container():
+        st.markdown("<div class='step-container'>", unsafe_allow_html=True)
+        st.markdown("### 🚀 &nbsp;&nbsp; Étape 5: Envoi des emails", unsafe_allow_html=True)
+        
+        if st.session_state.distribution_mapping is not None:
+            total_emails = len(st.session_state.distribution_mapping)
+            mapping = st.session_state.distribution_mapping
+            email_to_send = mapping[(mapping["email"] != "Non attribué") & (mapping["file"] != "Non attribué") & (mapping["motif"] == "")]
+            nb_emails_to_send = len(email_to_send)
+            
+            st.info(f"ℹ️ {nb_emails_to_send} emails seront envoyés sur un total de {total_emails} enregistrements.")
+            
+            # Le journal d'envoi permet de reprendre une campagne interrompue
+            campaign_id = campaign_id_for(st.session_state.distribution_mapping, subject, st.session_state.distribution_csv)
+            
+            # Une campagne déjà lancée (éventuellement depuis un autre onglet) est simplement suivie
+            job = get_job(st.session_state.send_job_id) if st.session_state.send_job_id else None
+            # La campagne lancée depuis cette session reste suivie tant qu'elle tourne, même si
+            # l'objet ou la distribution ont changé depuis : pas de second envoi en parallèle
+            if job is None or (job.finished and job.campaign_id != campaign_id):
+                job = find_active_job(campaign_id)
+            if job is not None:
+                st.session_state.send_job_id = job.id
+            
+            if job is not None and not job.finished:
+                render_send_job(job.id)
+            else:
+                if job is not None:
+                    render_send_job_result(job)
+                
+                # Envois déjà confirmés : le journal n'est relu que si la campagne change ou qu'un envoi vient de se terminer
+                journal_key = (campaign_id, job.id if job is not None else None)
+                if st.session_state.get("already_sent_key") != journal_key:
+                    with SendJournal() as journal:
+                        st.session_state.already_sent = journal.confirmed(campaign_id)
+                    st.session_state.already_sent_key = journal_key
+                already_sent = st.session_state.already_sent
+                
+                with st.expander("🧪 Simulation (aucun envoi)", expanded=False):
+                    dry_run_enabled = st.checkbox("Simuler l'envoi", value=False, help="Chaque email est construit exactement comme pour l'envoi, puis écrit dans un fichier au lieu d'être envoyé")
+                    dry_run_path = st.text_input("Sortie de la simulation", value=os.path.join(DRY_RUN_DIR, f"{campaign_id}.mbox"), help="Fichier .mbox, ou dossier qui recevra un fichier .eml par email")
+                
+                if dry_run_enabled:
+                    send_button = st.button("🧪 Lancer la simulation", help="Construire tous les emails sans les envoyer")
+                else:
+                    send_button = st.button("🚀 Envoyer les emails", help="Envoyer les emails aux destinataires")
+                resume_button = False
+                if already_sent:
+                    st.warning(f"⚠️ {len(already_sent)} emails de cette campagne ont déjà été envoyés lors d'une exécution précédente.")
+                    resume_button = st.button("🔁 Reprendre l'envoi", help="Envoyer uniquement les emails pas encore confirmés")
+                
+                dry_run = None
+                if (send_button or resume_button) and dry_run_enabled:
+                    try:
+                        dry_run = DryRunOutput(dry_run_path)
+                    except OSError as e:
+                        st.error(f"❌ Sortie de la simulation impossible : {e}")
+                        send_button = resume_button = False
+                
+                if send_button or resume_button:
+                    skip = already_sent if resume_button else set()
+                    # Statuts rangés par ligne de distribution : rejets, places non attribuées
+                    # et envois déjà confirmés sont fixés d'emblée, le reste est à envoyer
+                    statuses = StatusTable.from_mapping(mapping, already_sent=skip)
+                    
+                    # Corps personnalisés rendus en une passe pour toute la distribution
+                    bodies = None
+                    if template.has_fields:
+                        values = lookup_contact_values(
+                            st.session_state.contacts_df, st.session_state.email_column,
+                            mapping["email"].tolist(), template.columns
+                        )
+                        bodies = template.render_many(values).tolist()
+                    
+                    jobs = []
+                    for index in statuses.pending_rows().tolist():
+                        attachment_file = statuses.files[index]  # Ce champ contient uniquement le nom du fichier
+                        job_spec = {
+                            "index": index,
+                            "email": statuses.emails[index],
+                            "file": attachment_file,
+                            "attachment_path": os.path.join(st.session_state.places_dir, attachment_file),
+                        }
+                        if bodies is not None:
+                            job_spec["body"] = bodies[index]
+                        jobs.append(job_spec)
+                    
+                    # Quota déjà consommé par chaque compte sur les dernières 24 h, toutes campagnes confondues
+                    quota_since = time.time() - QUOTA_WINDOW_SECONDS
+                    with SendJournal() as journal:
+                        accounts = [
+                            SenderAccount(
+                                spec["username"], spec["password"], smtp_server, smtp_port,
+                                daily_quota=spec["daily_quota"] or None, rate_per_minute=rate_per_minute or None,
+                                max_workers=max_workers, already_sent=journal.sent_since(spec["username"], quota_since)
+                            )
+                            for spec in sender_specs
+                        ]
+                    
+                    # L'envoi tourne en arrière-plan : les workers de chaque compte envoient en parallèle,
+                    # chacun avec sa propre connexion SMTP, et survivent aux reruns
+                    job = submit_send_job(
+                        campaign_id, jobs, statuses,
+                        smtp_server=smtp_server, smtp_port=smtp_port, username=username, password=password,
+                        subject=subject, body=body, is_html=is_html, max_workers=max_workers, throttle=throttle,
+                        rate_per_minute=rate_per_minute, max_attempts=max_attempts, accounts=accounts,
+                        tracer=Tracer(AggregatorSink()) if measure_timings else None,
+                        dry_run=dry_run
+                    )
+                    st.session_state.send_job_id = job.id
+                    st.rerun()
+        else:
+            st.warning("⚠️ Veuille d'abord générer la distribution à l'étape 2.")
+        st.markdown("</div>", unsafe_allow_html=True)
 
 def run_app():
     # Configuration de la page avec un thème plus épuré
@@ -97,6 +435,24 @@ def run_app():
     with st.sidebar.expander("Identifiants de connexion", expanded=True):
         username = st.text_input("Adresse email", value="", help="Votre adresse email Gmail")
         password = st.text_input("Mot de passe d'application", type="password", help="Mot de passe d'application Gmail")
+        daily_quota = st.number_input("Quota journalier", min_value=0, value=0, help="Emails envoyés au maximum par 24 h depuis ce compte (Gmail : 500). 0 = illimité")
+    with st.sidebar.expander("Comptes d'envoi supplémentaires", expanded=False):
+        extra_accounts = st.number_input("Nombre de comptes supplémentaires", min_value=0, max_value=10, value=0, help="Les destinataires sont répartis entre les comptes selon leur quota restant")
+        sender_specs = [{"username": username, "password": password, "daily_quota": daily_quota}]
+        for i in range(int(extra_accounts)):
+            st.markdown(f"**Compte {i + 2}**")
+            extra_username = st.text_input("Adresse email", value="", key=f"extra_username_{i}")
+            extra_password = st.text_input("Mot de passe d'application", type="password", key=f"extra_password_{i}")
+            extra_quota = st.number_input("Quota journalier", min_value=0, value=0, key=f"extra_quota_{i}")
+            if extra_username and extra_password:
+                sender_specs.append({"username": extra_username, "password": extra_password, "daily_quota": extra_quota})
+    with st.sidebar.expander("Options d'envoi", expanded=False):
+        max_workers = st.number_input("Envois simultanés", min_value=1, max_value=20, value=4, help="Nombre de connexions SMTP utilisées en parallèle par chaque compte")
+        throttle = st.number_input("Pause après chaque envoi (s)", min_value=0.0, value=0.0, step=0.1, help="Pause optionnelle de chaque worker entre deux envois")
+        rate_per_minute = st.number_input("Débit maximum (emails/minute)", min_value=0, value=60, help="Budget de chaque compte, partagé par ses workers et réduit automatiquement si le serveur répond 421/451. 0 = illimité")
+        max_attempts = st.number_input("Tentatives maximum", min_value=1, max_value=10, value=3, help="Nombre de tentatives pour un échec temporaire (4xx, connexion perdue)")
+        keep_connection = st.checkbox("Garder la connexion vérifiée", value=True, help="La connexion ouverte à l'étape 1 reste ouverte 2 minutes et est reprise par le premier envoi de chaque compte")
+        measure_timings = st.checkbox("Mesurer les temps par étape", value=False, help="Connexion, STARTTLS, login, pièce jointe, construction MIME, transfert DATA")
     
     # Informations utiles dans la sidebar
     with st.sidebar.expander("Aide", expanded=True):
@@ -111,14 +467,22 @@ def run_app():
     # Initialisation des variables de session
     if "contacts_df" not in st.session_state:
         st.session_state.contacts_df = None
+    if "contacts_columns" not in st.session_state:
+        st.session_state.contacts_columns = None
     if "email_column" not in st.session_state:
         st.session_state.email_column = None
     if "distribution_mapping" not in st.session_state:
         st.session_state.distribution_mapping = None
+    if "distribution_csv" not in st.session_state:
+        st.session_state.distribution_csv = None
     if "places_paths" not in st.session_state:
         st.session_state.places_paths = []
+    if "places_dir" not in st.session_state:
+        st.session_state.places_dir = None
     if "progress" not in st.session_state:
         st.session_state.progress = 0
+    if "send_job_id" not in st.session_state:
+        st.session_state.send_job_id = None
     
     # ------------------------------
     # Étape 1 : Vérification de la connexion SMTP
@@ -135,11 +499,19 @@ def run_app():
         
         if verify_btn:
             with st.spinner("Tentative de connexion au serveur SMTP..."):
-                connection_ok, message = check_smtp_connection(smtp_server, smtp_port, username, password)
-                if connection_ok:
-                    st.success("✅ Connexion réussie!")
-                else:
-                    st.error(f"❌ Erreur de connexion: {message}")
+                for spec in sender_specs:
+                    connection_ok, message = check_smtp_connection(
+                        smtp_server, smtp_port, spec["username"], spec["password"], keep_connection=keep_connection
+                    )
+                    account_label = f" ({spec['username']})" if len(sender_specs) > 1 else ""
+                    if connection_ok:
+                        st.success(f"✅ Connexion réussie!{account_label}")
+                    else:
+                        st.error(f"❌ Erreur de connexion{account_label}: {message}")
+            # Capacités relevées pendant la vérification, utilisées pour construire les emails
+            capabilities = get_smtp_capabilities(smtp_server, smtp_port)
+            if capabilities is not None:
+                st.caption(f"Serveur : {capabilities.describe()}")
         st.markdown("</div>", unsafe_allow_html=True)
 
     # ------------------------------
@@ -154,26 +526,76 @@ def run_app():
         
         with col1:
             contacts_file = st.file_uploader("Fichier de contacts (CSV/Excel)", type=["csv", "xlsx"])
+            contacts_status = st.empty()
             if contacts_file is not None:
                 try:
-                    df = load_contacts_file(contacts_file)
-                    st.session_state.contacts_df = df
-                    st.success(f"✅ {len(df)} contacts chargés")
+                    # Seul l'en-tête est lu ici, les colonnes utiles sont chargées après sélection
+                    st.session_state.contacts_columns = read_contacts_header(contacts_file)
                 except Exception as e:
-                    st.error(f"❌ Erreur: {e}")
+                    st.session_state.contacts_columns = None
+                    contacts_status.error(f"❌ Erreur: {e}")
         
         with col2:
-            places_files = st.file_uploader("Fichiers de places (PDF)", type=["pdf"], accept_multiple_files=True)
-            if places_files:
-                st.success(f"✅ {len(places_files)} fichiers PDF chargés")
+            places_mode = st.radio(
+                "Format des places",
+                options=["Un PDF par place", "PDF unique (une place par page)"],
+                horizontal=True,
+                help="PDF unique : l'export de la billetterie est découpé page par page."
+            )
+            if places_mode == "Un PDF par place":
+                places_files = st.file_uploader("Fichiers de places (PDF)", type=["pdf"], accept_multiple_files=True)
+                if places_files:
+                    st.success(f"✅ {len(places_files)} fichiers PDF chargés")
+            else:
+                bundle_file = st.file_uploader("PDF des places (une place par page)", type=["pdf"])
+                places_files = [bundle_file] if bundle_file is not None else []
+                if bundle_file is not None:
+                    st.success(f"✅ {bundle_file.name} chargé")
         
         # Sélection de la colonne email (uniquement après chargement du fichier contacts)
-        if st.session_state.contacts_df is not None:
+        allocation_rule = "Ordre du fichier"
+        allocation_column = None
+        allocation_seed = 0
+        # Champs {{colonne}} du modèle lus avec les contacts ; l'étape 4 relance la page s'ils changent
+        template_columns = compile_template(st.session_state.get("email_html", "")).columns
+        st.session_state.contacts_template_columns = template_columns
+        if contacts_file is not None and st.session_state.contacts_columns:
             st.session_state.email_column = st.selectbox(
                 "Sélectionne la colonne contenant les adresses email", 
-                options=st.session_state.contacts_df.columns.tolist()
+                options=st.session_state.contacts_columns
             )
             
+            # Règle d'attribution des places (ordre du fichier par défaut)
+            allocation_rule = st.selectbox(
+                "Règle d'attribution des places",
+                options=["Ordre du fichier", "Priorité", "Groupes", "Tirage au sort"],
+                help="Priorité : plus petite valeur servie en premier. Groupes : places consécutives pour une même valeur. Tirage au sort : ordre aléatoire reproductible."
+            )
+            if allocation_rule in ("Priorité", "Groupes"):
+                allocation_column = st.selectbox(
+                    "Colonne utilisée pour l'attribution",
+                    options=st.session_state.contacts_columns
+                )
+            elif allocation_rule == "Tirage au sort":
+                allocation_seed = st.number_input("Graine du tirage", min_value=0, value=0)
+            
+            # Chargement (mis en cache) des seules colonnes utilisées, y compris les champs {{colonne}} du modèle
+            usecols = [st.session_state.email_column]
+            if allocation_column is not None and allocation_column not in usecols:
+                usecols.append(allocation_column)
+            usecols += [c for c in template_columns if c in st.session_state.contacts_columns and c not in usecols]
+            try:
+                df = load_contacts_file(contacts_file, usecols=usecols, dtype={st.session_state.email_column: "string"})
+                st.session_state.contacts_df = df
+                contacts_status.success(f"✅ {len(df)} contacts chargés")
+            except Exception as e:
+                st.session_state.contacts_df = None
+                contacts_status.error(f"❌ Erreur: {e}")
+            
+        with st.expander("Filtrage des adresses", expanded=False):
+            allowed_domains_text = st.text_area("Domaines autorisés", value="", help="Un domaine par ligne (ou séparés par des virgules). Vide = tous les domaines")
+            blocked_domains_text = st.text_area("Domaines bloqués", value="", help="Un domaine par ligne (ou séparés par des virgules)")
+        
         validate_files = st.button("Valider les fichiers", help="Générer la distribution")
         
         if validate_files:
@@ -182,25 +604,50 @@ def run_app():
             else:
                 with st.spinner("Préparation de la distribution..."):
                     try:
-                        # Créer le dossier de destination s'il n'existe pas
-                        upload_folder = "uploaded_places"
-                        if not os.path.exists(upload_folder):
-                            os.makedirs(upload_folder)
+                        # Les places sont rangées dans un dossier propre à ce jeu de fichiers :
+                        # seuls les contenus nouveaux sont écrits, rien n'est partagé avec les autres sessions
+                        if places_mode == "Un PDF par place":
+                            st.session_state.places_dir, st.session_state.places_paths = save_uploaded_places(places_files)
+                            # Encodage des pièces jointes à l'avance, hors de la boucle d'envoi
+                            attachment_cache.precompute(st.session_state.places_paths)
                         else:
-                            # Vider le dossier s'il existe déjà
-                            for f in os.listdir(upload_folder):
-                                os.remove(os.path.join(upload_folder, f))
-
-                        # Sauvegarder les fichiers
-                        st.session_state.places_paths = save_uploaded_places(places_files, upload_folder)
+                            # Découpage page par page (les places sont encodées pendant le découpage)
+                            st.session_state.places_dir, st.session_state.places_paths = split_uploaded_bundle(places_files[0])
+                        # Nettoyage des jeux anciens, hors campagnes en cours
+                        attachment_store.gc(keep={st.session_state.places_dir} | active_attachment_dirs())
                         
                         # Créer la distribution
                         contacts_df = st.session_state.contacts_df[[st.session_state.email_column]].copy()
                         contacts_df.rename(columns={st.session_state.email_column: "email"}, inplace=True)
                         
+                        strategy = None
+                        if allocation_column is not None:
+                            contacts_df["allocation"] = st.session_state.contacts_df[allocation_column].to_numpy()
+                            if allocation_rule == "Priorité":
+                                strategy = PriorityTierStrategy("allocation")
+                            else:
+                                strategy = GroupStrategy("allocation")
+                        elif allocation_rule == "Tirage au sort":
+                            strategy = ShuffleStrategy(allocation_seed)
+                        
+                        # Normalisation et contrôle des adresses : les rejets n'atteignent jamais l'envoi
+                        contacts_df, rejected_df = validate_contacts(
+                            contacts_df,
+                            allowed_domains=parse_domain_list(allowed_domains_text),
+                            blocked_domains=parse_domain_list(blocked_domains_text)
+                        )
+                        
                         # Tri des fichiers de places par nom
                         sorted_places = sorted(st.session_state.places_paths)
-                        st.session_state.distribution_mapping = create_distribution_mapping(contacts_df, sorted_places)
+                        mapping = create_distribution_mapping(contacts_df, sorted_places, strategy=strategy)
+                        mapping["motif"] = ""
+                        rejected = pd.DataFrame({"email": rejected_df["email"], "file": "Non attribué", "motif": rejected_df["motif"]})
+                        # Fichiers et motifs en catégories : chaque texte n'est stocké qu'une fois
+                        st.session_state.distribution_mapping = pd.concat([mapping, rejected], ignore_index=True).astype({"file": "category", "motif": "category"})
+                        # CSV généré une seule fois par distribution (téléchargement et identifiant de campagne)
+                        st.session_state.distribution_csv = save_distribution_csv(st.session_state.distribution_mapping)
+                        if len(rejected):
+                            st.warning(f"⚠️ {len(rejected)} adresses rejetées (voir le motif dans l'aperçu).")
                         st.success("✅ Distribution générée avec succès!")
                     except Exception as e:
                         st.error(f"❌ Erreur lors du traitement: {e}")
@@ -221,12 +668,11 @@ def run_app():
                 hide_index=True
             )
             
-            csv_download = save_distribution_csv(st.session_state.distribution_mapping)
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
                 st.download_button(
                     label="📥 Télécharger le récapitulatif CSV",
-                    data=csv_download,
+                    data=st.session_state.distribution_csv,
                     file_name="distribution.csv",
                     mime="text/csv"
                 )
@@ -234,175 +680,10 @@ def run_app():
             st.info("ℹ️ La distribution n'a pas encore été générée. Veuilles à valider les fichiers à l'étape 2.")
         st.markdown("</div>", unsafe_allow_html=True)
 
-    # ------------------------------
-    # Étape 4 : Rédaction de l'email
-    # ------------------------------
-    with st.container():
-        st.markdown("<div class='step-container'>", unsafe_allow_html=True)
-        st.markdown("### ✉️ &nbsp;&nbsp; Étape 4: Rédaction de l'email", unsafe_allow_html=True)
-        
-        subject = st.text_input("Objet de l'email", value="🎟️ Ta place pour PARIS BASKETBALL - XXX")
-        
-        # Section d'aide pour récupérer le code HTML de Gmail, maintenant dans un expander
-        with st.expander("💡 Aide : Comment récupérer le code HTML d'un brouillon Gmail   ↓↓↓"):
-            st.markdown("""
-            <div class="gmail-help">
-                <p><strong>Procédure étape par étape :</strong></p>
-                <ol>
-                    <li>Rédige ton email brouillon dans Gmail avec toute la mise en forme souhaitée</li>
-                    <li>Fais un clic droit avec ta souris sur la zone de rédaction et sélectionne "Inspecter"</li>
-                    <li>Sélectionne la petite flèche tout en haut à gauche de la barre qui s'est ouverte</li>
-                    <li>Survole ton message avec ton curseur et clique une fois que tout le texte est en surbrillance</li>
-                    <li>Copie le code associé (commençant par div...) qui est en surbrillance sur la barre de droite</li>
-                    <li>Colle-le dans la zone de saisie ci-dessous</li>
-                </ol>
-                <p><em>Note : Ne t'inquiète pas des balises div, les destinataires verront uniquement la mise en forme finale.</em></p>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        # Format de l'email uniquement en HTML
-        default_html = """
-            <div dir="ltr">Hello !
-            <div>
-            <br>
-            </div>
-            <div>C'est le moment d'accueillir&nbsp;à la maison une équipe qu'il faudra&nbsp;
-                <b>
-                    <span zeum4c1="PR_5_0" data-ddnwab="PR_5_0" aria-invalid="grammar" class="Lm ng">BATTRE</span>&nbsp;
-                </b>à n'importe quel prix !!!&nbsp;
-                <img data-emoji="🔥" class="an1" alt="🔥" aria-label="🔥" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f525/72.png" loading="lazy">
-                </div>
-                <div>
-                    <br>
-                    </div>
-                    <div>
-                        <b>Voici&nbsp;ta&nbsp;place&nbsp;pour le match contre XXX.&nbsp;
-                            <img data-emoji="🎟️" class="an1" alt="🎟️" aria-label="🎟️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f39f_fe0f/72.png" loading="lazy">
-                            </b>
-                        </div>
-                        <div>
-                            <b>
-                                <br>
-                                </b>
-                            </div>
-                            <div>
-                                <img data-emoji="⚠️" class="an1" alt="⚠️" aria-label="⚠️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/26a0_fe0f/72.png" loading="lazy">&nbsp;Si tu ne peux assister à cette rencontre et que tu souhaites redistribuer ta place n'hésite pas à nous le préciser en répondant à ce mail ou à nous envoyer ta place sur WhatsApp.&nbsp;
-                                    <img data-emoji="🙏" class="an1" alt="🙏" aria-label="🙏" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f64f/72.png" loading="lazy">
-                                    </div>
-                                    <div>
-                                        <br>
-                                        </div>
-                                        <div>Il va falloir&nbsp;
-                                            <b>RÉPONDRE PRÉSENT&nbsp;</b>en tribune et donner tout ce que tu as pour pousser nos joueurs à gagner ce match.&nbsp;
-                                            <img data-emoji="🌋" class="an1" alt="🌋" aria-label="🌋" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f30b/72.png" loading="lazy">&nbsp;
-                                                <img data-emoji="🗣️" class="an1" alt="🗣️" aria-label="🗣️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f5e3_fe0f/72.png" loading="lazy">
-                                                    <img data-emoji="🥁" class="an1" alt="🥁" aria-label="🥁" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f941/72.png" loading="lazy">
-                                                    </div>
-                                                    <div>
-                                                        <br>
-                                                        </div>
-                                                        <div>
-                                                            <br>
-                                                            </div>
-                                                            <div>
-                                                                <b>
-                                                                    <font color="#ff0000">
-                                                                        <img data-emoji="⌚" class="an1" alt="⌚" aria-label="⌚" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/231a/72.png" loading="lazy">&nbsp;RDV HH:MM en tribune
-                                                                        </font>
-                                                                    </b>
-                                                                </div>
-                                                                <div>
-                                                                    <p>
-                                                                        <b>DRESSCODE : T-SHIRT&nbsp;PARISII&nbsp;OU NOIR&nbsp;
-                                                                            <img data-emoji="⚫" class="an1" alt="⚫" aria-label="⚫" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/26ab/72.png" loading="lazy">
-                                                                            </b>️
-                                                                        </p>
-                                                                        <p>MERCI ET ON COMPTE SUR TOI !!!&nbsp;
-                                                                            <img data-emoji="🖤" class="an1" alt="🖤" aria-label="🖤" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f5a4/72.png" loading="lazy">
-                                                                                <img data-emoji="❤️" class="an1" alt="❤️" aria-label="❤️" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/2764_fe0f/72.png" loading="lazy">
-                                                                                    <img data-emoji="💙" class="an1" alt="💙" aria-label="💙" draggable="false" src="https://fonts.gstatic.com/s/e/notoemoji/16.0/1f499/72.png" loading="lazy">
-                                                                                    </p>
-                                                                                    <p>Le Bureau du&nbsp;KOP&nbsp;Parisii</p>
-                                                                                </div>
-                                                                            </div>
-        """.strip()
-
-        correct_emojis_style = """
-        <style>
-            img {
-                height: 1em !important;
-                width: 1em !important;
-            }
-        </style>
-        """
-
-        body = correct_emojis_style + '\n' + st.text_area("Contenu HTML de l'email", value=default_html, height=300)
-        is_html = True
-            
-        # Aperçu HTML
-        with st.expander("Aperçu de l'email", expanded=True):
-            st.markdown(body, unsafe_allow_html=True)
-        st.markdown("</div>", unsafe_allow_html=True)
-
-    # ------------------------------
-    # Étape 5 : Envoi des emails
-    # ------------------------------
-    with st.container():
-        st.markdown("<div class='step-container'>", unsafe_allow_html=True)
-        st.markdown("### 🚀 &nbsp;&nbsp; Étape 5: Envoi des emails", unsafe_allow_html=True)
-        
-        if st.session_state.distribution_mapping is not None:
-            total_emails = len(st.session_state.distribution_mapping)
-            email_to_send = st.session_state.distribution_mapping[st.session_state.distribution_mapping["email"] != "Non attribué"]
-            nb_emails_to_send = len(email_to_send)
-            
-            st.info(f"ℹ️ {nb_emails_to_send} emails seront envoyés sur un total de {total_emails} enregistrements.")
-            
-            send_button = st.button("🚀 Envoyer les emails", help="Envoyer les emails aux destinataires")
-            
-            if send_button:
-                statuses = []
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                current_email = st.empty()
-                
-                for index, row in st.session_state.distribution_mapping.iterrows():
-                    email_addr = row["email"]
-                    attachment_file = row["file"]  # Ce champ contient uniquement le nom du fichier
-                    
-                    # Calcul de la progression
-                    progress = min(100, int(100 * (index + 1) / nb_emails_to_send))
-                    progress_bar.progress(progress)
-                    st.session_state.progress = progress
-                    
-                    # On tente d'envoyer l'email uniquement si une place a été attribuée
-                    if email_addr == "Non attribué":
-                        status_text.text(f"Traitement: {index+1}/{nb_emails_to_send} - Place non attribuée")
-                        statuses.append({"email": email_addr, "fichier": attachment_file, "statut": "Aucun envoi (place non attribuée)"})
-                        continue
-                    
-                    # Affichage de l'email en cours d'envoi
-                    current_email.markdown(f"**Envoi en cours**: {email_addr}")
-                    status_text.text(f"Traitement: {index+1}/{nb_emails_to_send}")
-                    
-                    attachment_path = os.path.join("uploaded_places", attachment_file)
-                    success, msg = send_email_message(
-                        smtp_server, smtp_port, username, password,
-                        email_addr, subject, body, attachment_path, is_html=is_html
-                    )
-                    status_msg = "Succès" if success else f"Erreur: {msg}"
-                    statuses.append({"email": email_addr, "fichier": attachment_file, "statut": status_msg})
-                    
-                    # Pause pour permettre de voir l'avancement
-                    time.sleep(0.5)
-                
-                current_email.empty()
-                status_text.text("Envoi terminé!")
-                st.session_state.send_statuses = statuses
-                st.success("✅ Tous les emails ont été traités!")
-        else:
-            st.warning("⚠️ Veuille d'abord générer la distribution à l'étape 2.")
-        st.markdown("</div>", unsafe_allow_html=True)
+    render_email_and_send_steps(
+        smtp_server, smtp_port, username, password, sender_specs,
+        max_workers, throttle, rate_per_minute, max_attempts, measure_timings
+    )
 
     # ------------------------------
     # Étape 6 : Récapitulatif des envois
@@ -412,31 +693,46 @@ def run_app():
         st.markdown("### 📊 &nbsp;&nbsp; Étape 6: Récapitulatif des envois", unsafe_allow_html=True)
         
         if "send_statuses" in st.session_state:
-            statuses_df = pd.DataFrame(st.session_state.send_statuses)
-            
-            # Comptage des succès et échecs
-            success_count = sum(1 for status in st.session_state.send_statuses if "Succès" in status["statut"])
-            error_count = sum(1 for status in st.session_state.send_statuses if "Erreur" in status["statut"])
-            skipped_count = sum(1 for status in st.session_state.send_statuses if "Aucun envoi" in status["statut"])
+            # Compteurs tenus à jour pendant l'envoi ; tableau reconstruit seulement si un statut a changé
+            statuses = st.session_state.send_statuses
+            counts = statuses.category_counts()
             
             # Affichage des statistiques dans des métriques
-            col1, col2, col3 = st.columns(3)
-            col1.metric("Envois réussis", success_count)
-            col2.metric("Envois en échec", error_count)
-            col3.metric("Places restantes", skipped_count)
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Envois réussis", counts["success"])
+            col2.metric("Envois en échec", counts["error"])
+            col3.metric("Places restantes", counts["skipped"])
+            col4.metric("Adresses rejetées", counts["rejected"])
             
             # Tableau récapitulatif
             st.dataframe(
-                statuses_df,
+                statuses.to_frame(),
                 use_container_width=True,
                 hide_index=True
             )
             
-            # Téléchargement du rapport
-            csv_report = statuses_df.to_csv(index=False).encode("utf-8")
+            # Répartition des envois réussis entre les comptes d'envoi
+            sent_by_account = statuses.sent_by_sender
+            if len(sent_by_account) > 1:
+                with st.expander("📨 Envois par compte", expanded=False):
+                    st.dataframe(
+                        pd.DataFrame(list(sent_by_account.items()), columns=["Compte", "Envois réussis"]),
+                        use_container_width=True, hide_index=True
+                    )
+            
+            # Temps par étape, si la mesure était activée pour cette campagne
+            if st.session_state.get("send_timings"):
+                with st.expander("⏱️ Temps par étape", expanded=False):
+                    timings_df = pd.DataFrame(st.session_state.send_timings).rename(columns={
+                        "phase": "Étape", "count": "Mesures", "total_ms": "Total (ms)",
+                        "avg_ms": "Moyenne (ms)", "max_ms": "Max (ms)", "errors": "Erreurs"
+                    })
+                    st.dataframe(timings_df, use_container_width=True, hide_index=True)
+            
+            # Rapport CSV reconstruit seulement si des statuts ont changé
             st.download_button(
                 label="📥 Télécharger le rapport d'envoi", 
-                data=csv_report,
+                data=statuses.to_csv(),
                 file_name="rapport_envoi.csv",
                 mime="text/csv"
             )
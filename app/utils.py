@@ -1,54 +1,171 @@
 import pandas as pd
+import hashlib
+import importlib.util
+import io
 import os
+import threading
+from collections import OrderedDict
+from app.attachment_store import attachment_store
 
-def load_contacts_file(file_uploaded):
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+CONTACTS_CACHE_DIR = ".contacts_cache"
+CONTACTS_CACHE_SIZE = 8
+CONTACTS_DISK_CACHE_SIZE = 20
+UPLOADED_DIGESTS_SIZE = 64
+
+# Contacts déjà parsés, partagés entre les reruns et les sessions du processus
+_contacts_cache = OrderedDict()
+_contacts_cache_lock = threading.Lock()
+# Empreintes des derniers uploads (LRU, UPLOADED_DIGESTS_SIZE entrées)
+_uploaded_digests = OrderedDict()
+
+def _contacts_file_kind(file_uploaded):
+    file_name = file_uploaded.name.lower()
+    if file_name.endswith('.csv'):
+        return "csv"
+    if file_name.endswith(('.xls', '.xlsx')):
+        return "excel"
+    raise ValueError("Format de fichier non supporté. Veuillez utiliser CSV ou Excel.")
+
+def uploaded_file_digest(file_uploaded):
+    """
+    Empreinte sha256 du contenu du fichier uploadé.
+    Mémorisée par identifiant d'upload Streamlit pour ne pas re-hasher à chaque rerun.
+    """
+    file_id = getattr(file_uploaded, "file_id", None)
+    if file_id is not None:
+        with _contacts_cache_lock:
+            if file_id in _uploaded_digests:
+                _uploaded_digests.move_to_end(file_id)
+                return _uploaded_digests[file_id]
+    digest = hashlib.sha256(file_uploaded.getbuffer()).hexdigest()
+    if file_id is not None:
+        with _contacts_cache_lock:
+            _uploaded_digests[file_id] = digest
+            while len(_uploaded_digests) > UPLOADED_DIGESTS_SIZE:
+                _uploaded_digests.popitem(last=False)
+    return digest
+
+def _cached_contacts(key, load):
+    """Cache LRU en mémoire des contacts déjà parsés (CONTACTS_CACHE_SIZE entrées)."""
+    with _contacts_cache_lock:
+        if key in _contacts_cache:
+            _contacts_cache.move_to_end(key)
+            return _contacts_cache[key]
+    value = load()
+    with _contacts_cache_lock:
+        _contacts_cache[key] = value
+        while len(_contacts_cache) > CONTACTS_CACHE_SIZE:
+            _contacts_cache.popitem(last=False)
+    return value
+
+def _contacts_parquet_path(digest):
+    return os.path.join(CONTACTS_CACHE_DIR, f"{digest}.parquet")
+
+def _persist_contacts(df, digest):
+    """Sauvegarde un fichier Excel parsé au format Parquet pour les chargements suivants."""
+    if not HAS_PYARROW:
+        return
+    try:
+        os.makedirs(CONTACTS_CACHE_DIR, exist_ok=True)
+        df.to_parquet(_contacts_parquet_path(digest), index=False)
+        # Éviction des fichiers les plus anciens
+        cached_files = sorted(
+            (os.path.join(CONTACTS_CACHE_DIR, f) for f in os.listdir(CONTACTS_CACHE_DIR)),
+            key=os.path.getmtime
+        )
+        for path in cached_files[:-CONTACTS_DISK_CACHE_SIZE]:
+            os.remove(path)
+        print(f"Log (utils): Contacts sauvegardés au format Parquet ({digest[:12]})")
+    except Exception as e:
+        # Colonnes de types mélangés par exemple : on se passe simplement du cache disque
+        print(f"Log (utils): Impossible de sauvegarder les contacts en Parquet: {e}")
+
+def read_contacts_header(file_uploaded):
+    """
+    Retourne la liste des colonnes du fichier contacts en ne lisant que l'en-tête.
+    """
+    kind = _contacts_file_kind(file_uploaded)
+    digest = uploaded_file_digest(file_uploaded)
+
+    def load():
+        parquet_path = _contacts_parquet_path(digest)
+        if kind == "csv":
+            return pd.read_csv(io.BytesIO(file_uploaded.getbuffer()), nrows=0).columns.tolist()
+        if HAS_PYARROW and os.path.exists(parquet_path):
+            import pyarrow.parquet
+            return pyarrow.parquet.read_schema(parquet_path).names
+        return pd.read_excel(io.BytesIO(file_uploaded.getbuffer()), nrows=0).columns.tolist()
+
+    return _cached_contacts((digest, "header"), load)
+
+def load_contacts_file(file_uploaded, usecols=None, dtype=None):
     """
     Charge un fichier contacts au format CSV ou Excel
     et retourne un DataFrame.
+    Seules les colonnes `usecols` sont lues (toutes par défaut), avec les types `dtype`.
+    Le résultat est mis en cache selon l'empreinte du fichier : le DataFrame
+    retourné est partagé et ne doit pas être modifié en place.
     """
-    file_name = file_uploaded.name.lower()
-    if file_name.endswith('.csv'):
-        df = pd.read_csv(file_uploaded)
-    elif file_name.endswith(('.xls', '.xlsx')):
-        df = pd.read_excel(file_uploaded)
-    else:
-        raise ValueError("Format de fichier non supporté. Veuillez utiliser CSV ou Excel.")
+    kind = _contacts_file_kind(file_uploaded)
+    digest = uploaded_file_digest(file_uploaded)
+    usecols = list(usecols) if usecols else None
+    key = (digest, tuple(usecols) if usecols else None, tuple(sorted((dtype or {}).items())))
+
+    def load():
+        parquet_path = _contacts_parquet_path(digest)
+        if kind == "csv":
+            # Les types sont appliqués après lecture : le moteur pyarrow rejette un dtype
+            # partiel quand une colonne d'entiers contient des cellules vides
+            engine = "pyarrow" if HAS_PYARROW else None
+            df = pd.read_csv(io.BytesIO(file_uploaded.getbuffer()), usecols=usecols, engine=engine)
+        elif HAS_PYARROW and os.path.exists(parquet_path):
+            df = pd.read_parquet(parquet_path, columns=usecols)
+        else:
+            # Premier chargement : le classeur complet est parsé une seule fois puis sauvegardé
+            df = pd.read_excel(io.BytesIO(file_uploaded.getbuffer()))
+            _persist_contacts(df, digest)
+            if usecols:
+                df = df[usecols]
+        return df.astype(dtype) if dtype else df
+
+    df = _cached_contacts(key, load)
     print("Log (utils): Contacts chargé avec colonnes:", df.columns.tolist())
     return df
 
-def save_uploaded_places(places_files, upload_folder):
+def save_uploaded_places(places_files, store=attachment_store):
     """
-    Sauvegarde les fichiers uploadés dans un dossier local et retourne la liste des chemins.
+    Ajoute les fichiers uploadés au magasin de pièces jointes et retourne
+    (dossier du jeu de places, chemins des fichiers).
+    Seuls les contenus pas encore stockés sont écrits, directement depuis le
+    tampon de l'upload (getbuffer, sans copie).
     """
-    saved_paths = []
-    for f in places_files:
-        file_path = os.path.join(upload_folder, f.name)
-        with open(file_path, "wb") as out_file:
-            out_file.write(f.getbuffer())
-        saved_paths.append(file_path)
-        print(f"Log (utils): Fichier sauvegardé : {file_path}")
-    return saved_paths
+    entries = [(f.name, store.add(f.getbuffer(), digest=uploaded_file_digest(f))) for f in places_files]
+    folder, saved_paths = store.publish(entries)
+    print(f"Log (utils): {len(saved_paths)} fichiers de places dans {folder}")
+    return folder, saved_paths
 
-def create_distribution_mapping(contacts_df, places_paths):
+def create_distribution_mapping(contacts_df, places_paths, strategy=None):
     """
     Associe chaque contact à un fichier de place en utilisant l'ordre d'apparition.
     Si le nombre de places dépasse celui des contacts, ajoute une ligne avec "Non attribué".
     Pour le récapitulatif, seule la partie nom de fichier est conservée.
+    Une AllocationStrategy peut réordonner les contacts avant l'attribution.
+    La colonne des fichiers est catégorielle ("Non attribué" n'est stocké qu'une fois).
     """
-    mapping = []
+    if strategy is not None:
+        contacts_df = strategy.order_contacts(contacts_df)
     nb_contacts = len(contacts_df)
     nb_places = len(places_paths)
     print(f"Log (utils): Nombre de contacts: {nb_contacts}, Nombre de places: {nb_places}")
 
-    max_rows = max(nb_contacts, nb_places)
-    for idx in range(max_rows):
-        email_addr = contacts_df.iloc[idx]["email"] if idx < nb_contacts else "Non attribué"
-        if idx < nb_places:
-            file_name = os.path.basename(places_paths[idx])
-        else:
-            file_name = "Non attribué"
-        mapping.append({"email": email_addr, "file": file_name})
-    return pd.DataFrame(mapping)
+    # Alignement des deux colonnes, complétées par "Non attribué" jusqu'à la plus longue
+    rows = pd.RangeIndex(max(nb_contacts, nb_places))
+    emails = contacts_df["email"].reset_index(drop=True).reindex(rows, fill_value="Non attribué")
+    files = pd.Series([os.path.basename(path) for path in places_paths], dtype=object)
+    files = files.reindex(rows, fill_value="Non attribué")
+    return pd.DataFrame({"email": emails, "file": files.astype("category")})
 
 def save_distribution_csv(mapping_df):
     """
@@ -57,3 +174,16 @@ def save_distribution_csv(mapping_df):
     csv_str = mapping_df.to_csv(index=False)
     print("Log (utils): CSV de distribution généré.")
     return csv_str.encode("utf-8")
+
+def lookup_contact_values(contacts_df, email_column, emails, columns):
+    """
+    Valeurs des colonnes `columns` pour chaque adresse de `emails` (adresses
+    normalisées, comme après validation), dans le même ordre.
+    Pour une adresse en double, la première ligne l'emporte ; une adresse
+    inconnue ou une colonne absente donne des valeurs manquantes.
+    """
+    keys = contacts_df[email_column].astype("string").str.strip().str.lower()
+    columns = [column for column in columns if column in contacts_df.columns]
+    table = contacts_df[columns].set_axis(pd.Index(keys), axis=0)
+    table = table[~table.index.duplicated(keep="first")]
+    return table.reindex(pd.Index(emails, dtype="string")).reset_index(drop=True)
@@ -0,0 +1,59 @@
+import re
+from functools import lru_cache
+import pandas as pd
+
+# Syntaxe courante d'une adresse : partie locale, "@", domaine avec au moins un point
+EMAIL_PATTERN = (
+    r"[a-z0-9.!#$%&'*+/=?^_`{|}~-]+"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?"
+)
+
+REASON_EMPTY = "Adresse vide"
+REASON_INVALID = "Adresse invalide"
+REASON_DUPLICATE = "Doublon"
+REASON_NOT_ALLOWED = "Domaine non autorisé"
+REASON_BLOCKED = "Domaine bloqué"
+
+@lru_cache(maxsize=32)
+def parse_domain_list(text):
+    """
+    Transforme une liste de domaines saisie (séparés par des virgules, espaces
+    ou retours à la ligne) en frozenset normalisé. Le résultat est mis en cache.
+    """
+    return frozenset(d.strip().lower().lstrip("@") for d in re.split(r"[\s,;]+", text or "") if d.strip())
+
+def validate_contacts(contacts_df, allowed_domains=None, blocked_domains=None):
+    """
+    Valide toute la colonne "email" en une passe vectorisée.
+    Les adresses sont normalisées (espaces, minuscules), puis contrôlées :
+    cellule vide, syntaxe, doublon (la première occurrence est conservée),
+    et domaines autorisés / bloqués si ces listes sont fournies.
+    Retourne (contacts valides avec l'email normalisé, contacts rejetés avec
+    leur adresse d'origine et une colonne "motif").
+    """
+    raw = contacts_df["email"]
+    emails = raw.astype("string").str.strip().str.lower()
+    domains = emails.str.rpartition("@")[2]
+
+    reasons = pd.Series(pd.NA, index=contacts_df.index, dtype="string")
+    empty = emails.isna() | (emails == "")
+    invalid = ~empty & ~emails.str.fullmatch(EMAIL_PATTERN).fillna(False).astype(bool)
+    checks = [(empty, REASON_EMPTY), (invalid, REASON_INVALID)]
+    if allowed_domains:
+        checks.append((~domains.isin(allowed_domains), REASON_NOT_ALLOWED))
+    if blocked_domains:
+        checks.append((domains.isin(blocked_domains), REASON_BLOCKED))
+    # Le premier motif rencontré l'emporte
+    for mask, reason in checks:
+        reasons = reasons.mask(reasons.isna() & mask.fillna(False).astype(bool), reason)
+    duplicate = reasons.isna() & emails.where(reasons.isna()).duplicated(keep="first")
+    reasons = reasons.mask(duplicate, REASON_DUPLICATE)
+
+    rejected_mask = reasons.notna()
+    valid_df = contacts_df[~rejected_mask].copy()
+    valid_df["email"] = emails[~rejected_mask]
+    rejected_df = contacts_df[rejected_mask].copy()
+    rejected_df["email"] = raw[rejected_mask].astype("string").fillna("")
+    rejected_df["motif"] = reasons[rejected_mask]
+    print(f"Log (validation): {len(valid_df)} adresses valides, {len(rejected_df)} rejetées")
+    return valid_df, rejected_df
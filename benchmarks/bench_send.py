@@ -0,0 +1,172 @@
+"""
+Benchmark de débit du chemin d'envoi contre un puits SMTP local.
+
+Démarre benchmarks.smtp_sink dans un processus séparé, génère des contacts
+et des PDF synthétiques, puis envoie la campagne :
+  - mode "serial"   : boucle send_email_message sur une seule SMTPSession ;
+  - mode "dispatch" : dispatch_emails avec --workers connexions en parallèle.
+Affiche emails/s, latences p50/p95/p99 par message, pic de RSS et temps par
+étape (voir app.instrumentation), et ajoute le résultat (une ligne JSON) au
+fichier --output pour comparer les exécutions.
+
+Usage : python -m benchmarks.bench_send --count 400 --size 200000 --workers 4 --latency 0.02
+Nécessite aiosmtpd (groupe bench : uv sync --group bench) et openssl pour le certificat STARTTLS.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Permet l'exécution directe du script depuis la racine du dépôt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.dispatcher import dispatch_emails
+from app.email_sender import SMTPSession, send_email_message
+from app.instrumentation import Tracer, AggregatorSink, JsonlTraceSink
+
+BODY = "<div>Hello !</div><div><b>Voici ta place pour le match.</b></div>" * 20
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_sink_process(port, latency, fault_rate):
+    """Lance le puits dans un sous-processus pour ne pas fausser la mesure de RSS."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.smtp_sink", "--port", str(port),
+         "--latency", str(latency), "--fault-rate", str(fault_rate)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    if "écoute" not in line:
+        process.kill()
+        raise RuntimeError(f"Le puits SMTP n'a pas démarré : {line!r}")
+    return process
+
+def make_attachments(directory, count, size):
+    """Crée `count` PDF synthétiques de `size` octets et retourne leurs chemins triés."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"place_{i:05d}.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n" + os.urandom(max(0, size - 9)))
+        paths.append(path)
+    return paths
+
+def percentile(values, q):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+def run_serial(host, port, jobs, tracer):
+    latencies = []
+    sent = failed = 0
+    with SMTPSession(host, port, "bench@example.com", "bench", tracer=tracer) as session:
+        for job in jobs:
+            started = time.perf_counter()
+            success, _ = send_email_message(
+                host, port, "bench@example.com", "bench", job["email"],
+                "Benchmark", BODY, job["attachment_path"], is_html=True, session=session, tracer=tracer
+            )
+            latencies.append(time.perf_counter() - started)
+            sent += success
+            failed += not success
+    return latencies, sent, failed
+
+def run_dispatch(host, port, jobs, workers, rate_per_minute, tracer):
+    latencies = []
+    sent = failed = 0
+    results = dispatch_emails(
+        jobs, host, port, "bench@example.com", "bench", "Benchmark", BODY,
+        is_html=True, max_workers=workers, rate_per_minute=rate_per_minute, retry_delay=0.1, tracer=tracer
+    )
+    for job, success, _ in results:
+        if "duration" in job:
+            latencies.append(job["duration"])
+        sent += success
+        failed += not success
+    return latencies, sent, failed
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du chemin d'envoi contre un puits SMTP local")
+    parser.add_argument("--mode", choices=["serial", "dispatch"], default="dispatch")
+    parser.add_argument("--count", type=int, default=200, help="Nombre de destinataires")
+    parser.add_argument("--size", type=int, default=100_000, help="Taille de chaque PDF (octets)")
+    parser.add_argument("--workers", type=int, default=4, help="Workers SMTP (mode dispatch)")
+    parser.add_argument("--rate", type=int, default=None, help="Budget emails/minute (mode dispatch)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence injectée par le puits (s)")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Proportion de 451 injectées")
+    parser.add_argument("--trace", default=None, help="Fichier JSONL recevant une mesure par étape et par message")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl"))
+    args = parser.parse_args()
+
+    # Le temps par étape est toujours agrégé ; la trace détaillée est optionnelle
+    sinks = [AggregatorSink()]
+    if args.trace:
+        sinks.append(JsonlTraceSink(args.trace))
+    tracer = Tracer(*sinks)
+
+    host, port = "127.0.0.1", free_port()
+    sink = start_sink_process(port, args.latency, args.fault_rate)
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_places_") as directory:
+            paths = make_attachments(directory, args.count, args.size)
+            jobs = [
+                {"index": i, "email": f"membre{i:05d}@example.com", "file": os.path.basename(path), "attachment_path": path}
+                for i, path in enumerate(paths)
+            ]
+            started = time.perf_counter()
+            if args.mode == "serial":
+                latencies, sent, failed = run_serial(host, port, jobs, tracer)
+            else:
+                latencies, sent, failed = run_dispatch(host, port, jobs, args.workers, args.rate, tracer)
+            elapsed = time.perf_counter() - started
+    finally:
+        sink.terminate()
+        sink.wait()
+        tracer.close()
+
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "mode": args.mode,
+        "count": args.count,
+        "size": args.size,
+        "workers": args.workers if args.mode == "dispatch" else 1,
+        "rate": args.rate,
+        "latency": args.latency,
+        "fault_rate": args.fault_rate,
+        "sent": sent,
+        "failed": failed,
+        "elapsed_s": round(elapsed, 4),
+        "emails_per_s": round(sent / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        # ru_maxrss est exprimé en Ko sous Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "phases": tracer.summary(),
+    }
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Serveur SMTP local (puits) pour les benchmarks d'envoi, basé sur aiosmtpd.
+Les messages sont acceptés puis jetés. Options : STARTTLS (certificat
+auto-signé généré si besoin), AUTH acceptant n'importe quels identifiants,
+latence injectée avant la réponse à DATA et taux de réponses 4xx simulées.
+
+Usage : python -m benchmarks.smtp_sink --port 8025 --latency 0.01 --fault-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import time
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:  # pragma: no cover - dépendance optionnelle des benchmarks
+    Controller = None
+
+def generate_self_signed_cert(directory):
+    """Génère un certificat auto-signé (via openssl) et retourne (cert, clé)."""
+    cert_path = os.path.join(directory, "sink_cert.pem")
+    key_path = os.path.join(directory, "sink_key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key_path, "-out", cert_path],
+        check=True, capture_output=True
+    )
+    return cert_path, key_path
+
+class SinkHandler:
+    """Accepte et compte les messages, avec latence et erreurs temporaires optionnelles."""
+
+    def __init__(self, latency=0.0, fault_rate=0.0, fault_code="451 4.3.0 Erreur temporaire simulée"):
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_code = fault_code
+        self.received = 0
+        self.faults = 0
+        self.bytes = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fault_rate and random.random() < self.fault_rate:
+            self.faults += 1
+            return self.fault_code
+        self.received += 1
+        self.bytes += len(envelope.content)
+        return "250 2.0.0 OK"
+
+def accept_any_login(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
+
+def start_sink(host="127.0.0.1", port=8025, latency=0.0, fault_rate=0.0, tls=True, auth=True, cert_dir=None):
+    """Démarre le puits dans un thread et retourne (controller, handler)."""
+    if Controller is None:
+        raise RuntimeError("aiosmtpd est requis pour les benchmarks : uv sync --group bench")
+    handler = SinkHandler(latency=latency, fault_rate=fault_rate)
+    smtp_parameters = {}
+    if tls:
+        cert_path, key_path = generate_self_signed_cert(cert_dir or tempfile.mkdtemp(prefix="smtp_sink_"))
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert_path, key_path)
+        smtp_parameters["tls_context"] = context
+    if auth:
+        smtp_parameters["authenticator"] = accept_any_login
+        smtp_parameters["auth_require_tls"] = tls
+    controller = Controller(handler, hostname=host, port=port, **smtp_parameters)
+    controller.start()
+    return controller, handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Puits SMTP local pour les benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence injectée avant la réponse à DATA (s)")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Proportion de réponses 451 simulées")
+    parser.add_argument("--no-tls", action="store_true", help="Ne pas proposer STARTTLS")
+    parser.add_argument("--no-auth", action="store_true", help="Ne pas proposer AUTH")
+    args = parser.parse_args()
+
+    controller, handler = start_sink(
+        args.host, args.port, latency=args.latency, fault_rate=args.fault_rate,
+        tls=not args.no_tls, auth=not args.no_auth
+    )
+    print(f"Puits SMTP à l'écoute sur {args.host}:{args.port}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop()
+        print(f"{handler.received} messages reçus, {handler.faults} erreurs simulées")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
-import streamlit as st
-from app.ui import run_app
+import sys
 
 if __name__ == "__main__":
+    # "python main.py send ..." : envoi en ligne de commande, sans importer Streamlit
+    if len(sys.argv) > 1 and sys.argv[1] == "send":
+        from app.cli import main
+        sys.exit(main(sys.argv[1:]))
+    from app.ui import run_app
     run_app()